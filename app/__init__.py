@@ -20,7 +20,6 @@ This module contains the microservice code for
     models
 """
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flasgger import Swagger
 
 # These next lines are positional:
@@ -59,17 +58,26 @@ app.config['SWAGGER'] = {
         },
         "ResponsePromotionObject": {
             "type": "object",
-            "required": ["counter", "discount_ratio", "name", "product_id", "promotion_id"],
+            "required": ["counter", "discount_ratio", "name", "product_id", "promotion_id",
+                         "version"],
             "properties": {
                 "promotion_id": {"type": "integer", "example": 1},
                 "name": {"type": "string", "example": "July4th"},
                 "product_id": {"type": "integer", "example": 1785},
                 "discount_ratio": {"type": "integer", "example": 75},
-                "counter": {"type": "integer", "example": 0}
+                "counter": {"type": "integer", "example": 0},
+                "version": {"type": "integer", "example": 1},
+                "start_date": {"type": "string", "format": "date-time",
+                               "example": "2018-07-04T00:00:00"},
+                "end_date": {"type": "string", "format": "date-time",
+                             "example": "2018-07-05T00:00:00"},
+                "max_redemptions": {"type": "integer", "example": 1000},
+                "rate_limit": {"type": "integer", "example": 100},
+                "rate_period": {"type": "integer", "example": 3600}
             },
             "example": {
                 "product_id": 1785, "name": "July4th",
-                "promotion_id": 0, "counter": 0, "discount_ratio": 75
+                "promotion_id": 0, "counter": 0, "discount_ratio": 75, "version": 1
             }
         },
         "Promotion": {
@@ -77,7 +85,18 @@ app.config['SWAGGER'] = {
             "properties": {
                 "name": {"type": "string", "example": "July4th"},
                 "product_id": {"type": "integer", "example": 1785},
-                "discount_ratio": {"type": "integer"}
+                "discount_ratio": {"type": "integer"},
+                "start_date": {"type": "string", "format": "date-time",
+                               "description": "UTC, null or missing if always started"},
+                "end_date": {"type": "string", "format": "date-time",
+                             "description": "UTC, null or missing if it never ends"},
+                "max_redemptions": {"type": "integer",
+                                    "description": "null or missing if unlimited"},
+                "rate_limit": {"type": "integer",
+                               "description": "redemptions per rate_period, null or "
+                                              "missing if unlimited"},
+                "rate_period": {"type": "integer",
+                                "description": "seconds, 3600 if missing"}
             },
             "example": {"product_id": 1785, "name": "July4th", "discount_ratio": 0}
         }
@@ -88,6 +107,7 @@ app.config['SWAGGER'] = {
 Swagger(app)
 
 # Initialize SQLAlchemy
-db = SQLAlchemy(app)
+from app.pool import PooledSQLAlchemy
+db = PooledSQLAlchemy(app)
 
 from app import server, models
@@ -0,0 +1,158 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Active Promotion Index module
+
+Keeps the validity windows of the promotions of every product in memory,
+in an interval tree per product, so the promotions of a product that are
+active at a given time are found without a query.
+
+A window is half open, a promotion is active from its start (included)
+to its end (excluded). Products are loaded on first use through a loader
+function, and a product is dropped and reloaded on its next lookup when
+one of its promotions is written. Writes made by other processes are not
+seen, so a product is also reloaded once it has been kept for the ttl.
+"""
+import threading
+import time
+
+_MISSING = object()
+
+
+class IntervalTree(object):
+    """
+    Static centered interval tree of (start, end, value) windows
+
+    Each node holds the windows that contain its center, sorted by start
+    and by end, so finding the windows that contain a point takes
+    O(log n + k) comparisons for k results. Empty windows are ignored.
+    """
+
+    def __init__(self, intervals):
+        self._root = self._build([interval for interval in intervals
+                                  if interval[0] < interval[1]])
+
+    @classmethod
+    def _build(cls, intervals):
+        if not intervals:
+            return None
+        starts = sorted(interval[0] for interval in intervals)
+        # a median start is contained by its own window, so no node is empty
+        center = starts[len(starts) // 2]
+        here, left, right = [], [], []
+        for interval in intervals:
+            if interval[1] <= center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_start = sorted(here, key=lambda interval: interval[0])
+        by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        return (center, by_start, by_end, cls._build(left), cls._build(right))
+
+    def stab(self, point):
+        """ Returns the values of the windows that contain point """
+        values = []
+        node = self._root
+        while node is not None:
+            center, by_start, by_end, left, right = node
+            if point < center:
+                # every window here ends after point, keep those started by then
+                for start, _, value in by_start:
+                    if start > point:
+                        break
+                    values.append(value)
+                node = left
+            else:
+                # every window here started by point, keep those not ended yet
+                for _, end, value in by_end:
+                    if end <= point:
+                        break
+                    values.append(value)
+                node = right
+        return values
+
+
+class ActivePromotionIndex(object):
+    """ In-memory product_id -> IntervalTree of promotion windows index """
+
+    def __init__(self, loader, ttl=None):
+        """
+        Args:
+            loader (callable): returns (promotion_id, start, end) of every
+                promotion of a product_id
+            ttl (float): seconds a product is kept before it is reloaded,
+                None keeps it until it is changed
+        """
+        self._loader = loader
+        self.ttl = ttl
+        self._trees = {}          # product_id -> (IntervalTree, promotion_ids, stale time)
+        self._product_of = {}     # promotion_id -> product_id of a loaded tree
+        self._lock = threading.Lock()
+        self._version = 0         # bumped on every write so loads can't store stale data
+
+    def active(self, product_id, point):
+        """ Returns the sorted promotion_ids of a product that are active at point """
+        loaded = self._trees.get(product_id, _MISSING)
+        if loaded is _MISSING or (loaded[2] is not None and loaded[2] <= time.time()):
+            version = self._version
+            rows = list(self._loader(product_id))
+            loaded = (IntervalTree((start, end, promotion_id) for promotion_id, start, end in rows),
+                      [row[0] for row in rows],
+                      time.time() + self.ttl if self.ttl is not None else None)
+            with self._lock:
+                if version == self._version:
+                    self._forget(product_id)
+                    self._trees[product_id] = loaded
+                    for promotion_id in loaded[1]:
+                        self._product_of[promotion_id] = product_id
+        promotion_ids = loaded[0].stab(point)
+        promotion_ids.sort()
+        return promotion_ids
+
+    def _forget(self, product_id):
+        """ Drops a product so it is reloaded, the lock must be held """
+        loaded = self._trees.pop(product_id, None)
+        if loaded is not None:
+            for promotion_id in loaded[1]:
+                self._product_of.pop(promotion_id, None)
+
+    def promotion_saved(self, promotion_id, product_id):
+        """ Applies a created or updated promotion to the index """
+        with self._lock:
+            self._version += 1
+            previous_product = self._product_of.get(promotion_id)
+            if previous_product is not None:
+                self._forget(previous_product)
+            self._forget(product_id)
+
+    def promotion_removed(self, promotion_id):
+        """ Applies a deleted promotion to the index """
+        with self._lock:
+            self._version += 1
+            product_id = self._product_of.get(promotion_id)
+            if product_id is not None:
+                self._forget(product_id)
+
+    def clear(self):
+        """ Drops every product from the index """
+        with self._lock:
+            self._version += 1
+            self._trees = {}
+            self._product_of = {}
+
+    def __len__(self):
+        return len(self._trees)
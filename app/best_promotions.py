@@ -0,0 +1,193 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Best Promotion Index module
+
+Keeps the best promotion (highest discount_ratio, lowest promotion_id on
+ties) of every product in memory so it can be looked up in O(1).
+
+Only the promotions whose validity window contains the time of the
+lookup compete. Each product keeps the time its best promotion may change,
+the end of that promotion or the next start of another one, and is
+reloaded by the first lookup at or after it.
+
+Products are loaded on first use through a loader function, or all at
+once with rebuild(). Writes are applied incrementally: an active promotion
+that beats the current best replaces it, and a product whose best
+promotion is changed or removed is reloaded on its next lookup.
+
+Writes made by other processes are not seen, so a product is also
+reloaded once it has been kept for the ttl, and can be reloaded at once
+when its best promotion turns out to be gone.
+"""
+import threading
+import time
+
+_MISSING = object()
+
+
+class BestPromotionIndex(object):
+    """ In-memory product_id -> best promotion index """
+
+    def __init__(self, loader, ttl=None):
+        """
+        Args:
+            loader (callable): called with a product_id and a time, returns
+                the (discount_ratio, promotion_id) of the best promotion of
+                the product active at that time, or None if it has none, and
+                the time that may change, or None if it never does
+            ttl (float): seconds a product is kept before it is reloaded,
+                None keeps it until it is changed
+        """
+        self._loader = loader
+        self.ttl = ttl
+        self._best = {}           # product_id -> (discount_ratio, promotion_id) or None
+        self._expires = {}        # product_id -> time its best may change, if any
+        self._stale = {}          # product_id -> time.time() after which it is reloaded
+        self._product_of = {}     # promotion_id -> product_id it is the best of
+        self._lock = threading.Lock()
+        self._version = 0         # bumped on every write so loads can't store stale data
+
+    @staticmethod
+    def _beats(candidate, best):
+        """ Checks if a (discount_ratio, promotion_id) pair beats another """
+        if best is None:
+            return True
+        return candidate[0] > best[0] or (candidate[0] == best[0] and candidate[1] < best[1])
+
+    @staticmethod
+    def _earliest(first, second):
+        """ Returns the earlier of two times, either of which may be None """
+        if first is None or (second is not None and second < first):
+            return second
+        return first
+
+    def get(self, product_id, now):
+        """ Returns (discount_ratio, promotion_id) of the best promotion at now or None """
+        best = self._best.get(product_id, _MISSING)
+        if best is not _MISSING:
+            expires = self._expires.get(product_id)
+            stale = self._stale.get(product_id)
+            if (expires is None or now < expires) and (stale is None or time.time() < stale):
+                return best
+        version = self._version
+        best, expires = self._loader(product_id, now)
+        with self._lock:
+            if version == self._version:
+                self._set(product_id, best, expires)
+                if self.ttl is not None:
+                    self._stale[product_id] = time.time() + self.ttl
+        return best
+
+    def reload(self, product_id, now):
+        """ Loads a product again, after its best promotion was found missing """
+        with self._lock:
+            self._version += 1
+            self._forget(product_id)
+        return self.get(product_id, now)
+
+    def _set(self, product_id, best, expires):
+        """ Stores the best promotion of a product, the lock must be held """
+        old = self._best.get(product_id)
+        if old is not None:
+            self._product_of.pop(old[1], None)
+        self._best[product_id] = best
+        self._expires[product_id] = expires
+        if best is not None:
+            self._product_of[best[1]] = product_id
+
+    def _forget(self, product_id):
+        """ Drops a product so it is reloaded, the lock must be held """
+        old = self._best.pop(product_id, None)
+        self._expires.pop(product_id, None)
+        self._stale.pop(product_id, None)
+        if old is not None:
+            self._product_of.pop(old[1], None)
+
+    def promotion_saved(self, promotion_id, product_id, discount_ratio,
+                        start=None, end=None, now=None):
+        """
+        Applies a created or updated promotion to the index
+
+        A promotion without a start and an end is always active. Otherwise
+        it only competes if now is in its window, and a start after now
+        makes the product reload at that time.
+        """
+        with self._lock:
+            self._version += 1
+            previous_product = self._product_of.get(promotion_id)
+            if previous_product is not None:
+                # it was a best promotion and might not be any more
+                self._forget(previous_product)
+            if product_id not in self._best:
+                return
+            expires = self._expires.get(product_id)
+            if start is not None and now < start:
+                self._expires[product_id] = self._earliest(expires, start)
+            elif discount_ratio is not None and (end is None or now < end):
+                candidate = (discount_ratio, promotion_id)
+                if self._beats(candidate, self._best[product_id]):
+                    self._set(product_id, candidate, self._earliest(expires, end))
+
+    def promotion_removed(self, promotion_id):
+        """ Applies a deleted promotion to the index """
+        with self._lock:
+            self._version += 1
+            product_id = self._product_of.get(promotion_id)
+            if product_id is not None:
+                self._forget(product_id)
+
+    def rebuild(self, rows, now):
+        """
+        Replaces the index with the best promotion of every product at now
+
+        Args:
+            rows (iterable): (product_id, discount_ratio, promotion_id,
+                start, end) tuples
+        """
+        best = {}
+        ends = {}
+        starts = {}
+        for product_id, discount_ratio, promotion_id, start, end in rows:
+            if now < start:
+                starts[product_id] = self._earliest(starts.get(product_id), start)
+                continue
+            if discount_ratio is None or end <= now:
+                continue
+            candidate = (discount_ratio, promotion_id)
+            if self._beats(candidate, best.get(product_id)):
+                best[product_id] = candidate
+                ends[product_id] = end
+        with self._lock:
+            self._version += 1
+            self._best = best
+            self._expires = dict((product_id, self._earliest(ends[product_id],
+                                                             starts.get(product_id)))
+                                 for product_id in best)
+            self._product_of = dict((value[1], key) for key, value in best.items())
+            self._stale = dict.fromkeys(best, time.time() + self.ttl) \
+                if self.ttl is not None else {}
+
+    def clear(self):
+        """ Drops every product from the index """
+        with self._lock:
+            self._version += 1
+            self._best = {}
+            self._expires = {}
+            self._stale = {}
+            self._product_of = {}
+
+    def __len__(self):
+        return len(self._best)
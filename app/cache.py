@@ -0,0 +1,110 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache module
+
+A small thread safe LRU cache whose entries also expire after a
+time to live, used to keep serialized promotions in memory.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+GENERATION_STRIPES = 64
+
+
+class LRUCache(object):
+    """
+    Bounded least recently used cache with a per entry time to live
+
+    A maxsize of 0 disables the cache and a ttl of None keeps entries
+    until they are evicted or invalidated.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # bumped on invalidation so a slow reader can't cache stale data,
+        # striped by key so writes to one key don't block caching the rest
+        self._generations = [0] * GENERATION_STRIPES
+
+    def get(self, key):
+        """ Returns the cached value for key or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # re-inserting moves the key to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def generation(self, key):
+        """ Returns the invalidation generation to pass to set() after a load """
+        return self._generations[hash(key) % GENERATION_STRIPES]
+
+    def set(self, key, value, generation=None):
+        """
+        Stores a value, evicting the least recently used entry if full
+
+        If generation is given and the cache has been invalidated since it
+        was read, the value may already be stale and is not stored.
+        """
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation(key):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Removes key from the cache """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[hash(key) % GENERATION_STRIPES] += 1
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            self._entries.clear()
+            self._generations = [count + 1 for count in self._generations]
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        with self._lock:
+            return {"size": len(self._entries),
+                    "maxsize": self.maxsize,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations}
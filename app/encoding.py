@@ -0,0 +1,113 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON Encoding module
+
+Encodes the API responses with the JSON_ENCODER backend: ujson when it is
+installed (the default "auto" setting) or the standard library json module.
+Responses are compact unless JSONIFY_PRETTYPRINT_REGULAR is set.
+
+EncodedDict keeps its own encoding and ETag, so cached payloads are
+encoded and hashed once and then sent as is.
+"""
+import json
+from werkzeug.http import generate_etag
+from . import app
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def _ujson_dumps(data):
+    return ujson.dumps(data, escape_forward_slashes=False)
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+ENCODERS = {'json': _json_dumps}
+if ujson is not None:
+    ENCODERS['ujson'] = _ujson_dumps
+
+
+def encoder_name():
+    """ Returns the name of the encoder selected by JSON_ENCODER """
+    name = app.config['JSON_ENCODER']
+    if name == 'auto':
+        return 'ujson' if 'ujson' in ENCODERS else 'json'
+    return name if name in ENCODERS else 'json'
+
+
+def dumps(data):
+    """ Encodes data as a JSON string with the configured encoder """
+    if app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+        return json.dumps(data, indent=2, separators=(', ', ': '), sort_keys=True)
+    return ENCODERS[encoder_name()](data)
+
+
+class EncodedDict(dict):
+    """ A dictionary that remembers its JSON encoding, it must not be modified """
+    _encoded = None
+    _etag = None
+
+    def encoded(self):
+        """ Returns the JSON encoding, building it on the first call """
+        if self._encoded is None:
+            self._encoded = dumps(self)
+        return self._encoded
+
+    def etag(self, volatile=None):
+        """ Returns the ETag of the dictionary, hashing it on the first call """
+        if self._etag is None or self._etag[0] != volatile:
+            self._etag = (volatile, etag(dict(self), volatile))
+        return self._etag[1]
+
+
+def encode(data):
+    """ Returns the JSON response body of data """
+    return (data.encoded() if isinstance(data, EncodedDict) else dumps(data)) + '\n'
+
+
+def etag(data, volatile=None):
+    """
+    Returns a strong ETag of data
+
+    The ETag hashes a canonical encoding with sorted keys rather than the
+    response body, whose key order depends on how the dictionary was built.
+    The value of the volatile key, if data has it, is left out of the hash
+    and appended to it instead, so etag_base() can compare the rest alone.
+    """
+    if isinstance(data, EncodedDict):
+        return data.etag(volatile)
+    if volatile in data:
+        rest = dict((key, value) for key, value in data.items() if key != volatile)
+        return '{}-{}'.format(etag(rest), data[volatile])
+    return generate_etag(json.dumps(data, sort_keys=True, separators=(',', ':')))
+
+
+def etag_base(tag):
+    """ Returns the part of an ETag that doesn't depend on its volatile value """
+    return tag.partition('-')[0]
+
+
+def jsonify(*args, **kwargs):
+    """ Drop-in replacement for flask.jsonify that uses the configured encoder """
+    if args and kwargs:
+        raise TypeError('jsonify() takes either arguments or keywords, not both')
+    data = args[0] if len(args) == 1 else (list(args) if args else kwargs)
+    return app.response_class(encode(data), mimetype=app.config['JSONIFY_MIMETYPE'])
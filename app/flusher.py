@@ -0,0 +1,80 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background Flusher module
+
+The background thread of the in-memory write-behind buffers. It calls
+flush() every flush_interval seconds, or sooner when woken by wakeup(),
+and a final flush runs when the process exits.
+"""
+import atexit
+import threading
+
+
+class BackgroundFlusher(object):
+    """ Base class of the buffers that a background thread flushes """
+    thread_name = 'flush'
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self._thread_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._exit_hook = False
+
+    def flush(self):
+        """ Writes what is buffered, and logs and raises if the write fails """
+        raise NotImplementedError
+
+    def wakeup(self):
+        """ Asks the background thread to flush now """
+        self._wakeup.set()
+
+    def _run(self):
+        """ Background loop that flushes on the interval or when woken """
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # already logged, what failed is retried next time
+
+    def start(self):
+        """ Starts the background flush thread if it isn't running """
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.thread_name)
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._exit_hook:
+                atexit.register(self.stop)
+                self._exit_hook = True
+
+    def stop(self):
+        """ Stops the background thread and flushes what is left """
+        with self._thread_lock:
+            thread = self._thread
+            self._thread = None
+            if thread is not None:
+                self._stopping = True
+                self._wakeup.set()
+                thread.join()
+        return self.flush()
@@ -0,0 +1,303 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Idempotency module
+
+Lets clients retry a POST safely by sending an Idempotency-Key header.
+The first response to a key is kept in the idempotency_key table for a
+time to live, and a retry with the same key gets that response replayed
+without running the endpoint again, whichever instance it reaches.
+
+A key is bound to the method, path, query string and body it was first
+sent with, and reusing it for another request is refused with 422.
+
+The key is written in the same transaction as the first change its
+request commits, so the change and the key are stored together or not
+at all, and its response is recorded once it is known. A retry that
+finds the key without a response gets 409: the first request is still
+running, or it failed after its change was committed. Either way the
+change is not applied twice. The primary key also refuses the second of
+two requests with the same key racing on different instances, and its
+change is rolled back.
+
+A request that commits nothing, for example a redeem held by the
+redemption buffer, writes its key with its response. Only the responses
+below 500 are stored, and a request that failed without committing runs
+again when it is retried. Recorded responses are also cached in memory,
+as they never change.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import wraps
+import sqlalchemy
+from flask import request, make_response, g, has_request_context
+from flask_sqlalchemy import SignallingSession
+from werkzeug.exceptions import HTTPException, BadRequest, Conflict, UnprocessableEntity
+from . import db
+from .cache import LRUCache
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# Headers of a response that are stored and replayed, the hooks add the others
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+# Expired keys are deleted every this many claims
+PURGE_EVERY = 1000
+
+
+def digest(key):
+    """ Returns the sha1 of a key, its primary key in the idempotency_key table """
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Claim(object):
+    """ A key claimed by the request being served """
+
+    def __init__(self, key, fingerprint):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.committed = False    # set once the key is in a committed transaction
+
+
+class IdempotencyStore(object):
+    """ Store of the responses to the requests of each Idempotency-Key """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, maxsize=10000, ttl=86400):
+        self.ttl = ttl
+        self._responses = LRUCache(maxsize, ttl)
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._claims = 0
+
+    def begin(self, key, fingerprint):
+        """
+        Claims a key for a request, or returns its stored response
+
+        Returns (status, headers, body) of the response to replay, or None
+        when the request must run and finish() be called with its response.
+        Raises Conflict if the key's first request is still running, or
+        committed its change without recording a response, and
+        UnprocessableEntity if the key was used for another request.
+        """
+        with self._lock:
+            if key in self._in_flight:
+                raise Conflict('A request with this {} is still in progress.'.format(HEADER))
+            stored = self._responses.get(key)
+            if stored is None:
+                self._in_flight.add(key)
+                self._claims += 1
+                purge = self._claims % PURGE_EVERY == 0
+        if stored is None:
+            try:
+                if purge:
+                    self.purge()
+                stored = self._load(key)
+            except Exception:
+                self._release(key)
+                raise
+            if stored is None:
+                return None
+            self._release(key)
+        if stored[0] != fingerprint:
+            raise UnprocessableEntity('This {} was already used for another request.'
+                                      .format(HEADER))
+        if stored[1] is None:
+            raise Conflict('A request with this {} is still in progress, or was applied '
+                           'without recording its response.'.format(HEADER))
+        return stored[1]
+
+    def _load(self, key):
+        """ Returns the (fingerprint, response or None) stored for a key, or None """
+        row = IdempotencyKey.query.get(digest(key))
+        if row is None:
+            db.session.rollback()
+            return None
+        if row.created_at + self.ttl <= time.time():
+            db.session.delete(row)
+            db.session.commit()
+            return None
+        stored = (row.fingerprint, None)
+        if row.status is not None:
+            stored = (row.fingerprint,
+                      (row.status, [tuple(header) for header in json.loads(row.headers)],
+                       row.body))
+            self._responses.set(key, stored)
+        # the request starts from a new transaction
+        db.session.rollback()
+        return stored
+
+    def taken(self, key):
+        """ Checks if a key is stored, for a request that failed to commit it """
+        db.session.rollback()
+        return self._load(key) is not None
+
+    def finish(self, claim, response=None):
+        """
+        Releases a claimed key, recording its (status, headers, body) response if given
+
+        The key is stored with the response unless its request committed
+        it already. A response that can't be recorded is logged, the key
+        then keeps refusing retries.
+        """
+        try:
+            if response is not None:
+                self._record(claim, response)
+        finally:
+            self._release(claim.key)
+
+    def _record(self, claim, response):
+        """ Stores the response of a claimed key """
+        status_code, headers, body = response
+        values = dict(status=status_code, headers=json.dumps(headers), body=body)
+        try:
+            if claim.committed:
+                IdempotencyKey.query.filter_by(key_digest=digest(claim.key)).update(values)
+            else:
+                db.session.add(IdempotencyKey(key_digest=digest(claim.key),
+                                              fingerprint=claim.fingerprint,
+                                              created_at=int(time.time()), **values))
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # the key was taken meanwhile by a request that changed nothing here
+            db.session.rollback()
+            return
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error('Response to %s %s not recorded: %s', HEADER, claim.key, error)
+            return
+        self._responses.set(claim.key, (claim.fingerprint, response))
+
+    def forget(self, claim):
+        """ Deletes a committed key, for a request that failed without changing anything """
+        try:
+            IdempotencyKey.query.filter_by(key_digest=digest(claim.key)) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error('%s %s not deleted: %s', HEADER, claim.key, error)
+
+    def _release(self, key):
+        with self._lock:
+            self._in_flight.discard(key)
+
+    def purge(self):
+        """ Deletes the expired keys """
+        IdempotencyKey.query.filter(IdempotencyKey.created_at <= time.time() - self.ttl) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    def clear(self):
+        """ Drops every response cached in memory """
+        with self._lock:
+            self._responses.clear()
+
+    def stats(self):
+        """ Returns the store counters as a dictionary """
+        stats = self._responses.stats()
+        with self._lock:
+            stats['in_flight'] = len(self._in_flight)
+        return stats
+
+
+def fingerprint():
+    """ Returns a digest of the method, path, query string and body of the request """
+    digest = hashlib.sha1()
+    for part in (request.method, request.path, request.query_string,
+                 request.get_data(cache=True)):
+        digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def idempotent(store):
+    """
+    Returns a decorator that makes a view honour the Idempotency-Key header
+
+    Requests without the header run as usual. Responses with a 5xx status
+    aren't stored so the request can be retried. A client error raised by
+    the view frees a key it committed, so the view must only raise one
+    when it changed nothing.
+    """
+    def decorator(view):
+        @wraps(view)
+        def idempotent_view(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                raise BadRequest('The {} must be at most {} characters.'
+                                 .format(HEADER, MAX_KEY_LENGTH))
+            claim = Claim(key, fingerprint())
+            replay = store.begin(key, claim.fingerprint)
+            if replay is not None:
+                status_code, headers, body = replay
+                response = make_response(body, status_code, headers)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            stored = None
+            g.idempotency_claim = claim
+            try:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code < 500:
+                    headers = [(name, response.headers[name]) for name in REPLAYED_HEADERS
+                               if name in response.headers]
+                    stored = (response.status_code, headers, response.get_data())
+            except sqlalchemy.exc.IntegrityError:
+                # another instance committed the same key first
+                g.pop('idempotency_claim', None)
+                if not claim.committed and store.taken(key):
+                    raise Conflict('A request with this {} was already applied.'
+                                   .format(HEADER))
+                raise
+            except HTTPException as error:
+                if claim.committed and error.code < 500:
+                    g.pop('idempotency_claim', None)
+                    store.forget(claim)
+                raise
+            finally:
+                g.pop('idempotency_claim', None)
+                store.finish(claim, stored)
+            return response
+        return idempotent_view
+    return decorator
+
+
+def current_claim():
+    """ Returns the Claim of the request being served, if any """
+    return g.get('idempotency_claim') if has_request_context() else None
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'before_commit')
+def add_claimed_key(session):
+    """ Writes the claimed key in the first transaction its request commits """
+    claim = current_claim()
+    if claim is not None and not claim.committed:
+        session.add(IdempotencyKey(key_digest=digest(claim.key), fingerprint=claim.fingerprint,
+                                   created_at=int(time.time())))
+
+
+@sqlalchemy.event.listens_for(SignallingSession, 'after_commit')
+def mark_claimed_key(session):
+    """ Remembers that the claimed key was committed """
+    claim = current_claim()
+    if claim is not None:
+        claim.committed = True
@@ -0,0 +1,167 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Metrics module
+
+In-process request metrics rendered in the Prometheus text format:
+request counts by endpoint, method and status, latency histograms by
+endpoint and method, and the number and time of the SQL queries each
+request ran. Every update takes one short lock, so the counters are safe
+under threaded servers.
+
+The SQL queries are counted by engine events into the flask.g of the
+request that ran them, and added to its g.sql_profile when the request
+is profiled; queries run outside a request aren't counted.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """ Counts of observations by upper bound, with their sum """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Adds an observation, the caller holds the lock """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """ Returns the cumulative _bucket, _sum and _count sample lines """
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(labels + (('le', str(bound)),)), total))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), repr(self.sum)))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), self.count))
+        return lines
+
+
+class RequestMetrics(object):
+    """ Thread safe counters and histograms of the served requests """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Drops every observation """
+        with self._lock:
+            self._requests = defaultdict(int)        # (endpoint, method, status) -> count
+            self._latency = {}                       # (endpoint, method) -> Histogram
+            self._queries = {}                       # endpoint -> Histogram of queries
+            self._query_seconds = defaultdict(float)  # endpoint -> seconds in SQL
+
+    def observe(self, endpoint, method, status, seconds, queries=0, query_seconds=0.0):
+        """ Records a served request """
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            latency = self._latency.get((endpoint, method))
+            if latency is None:
+                latency = self._latency[(endpoint, method)] = Histogram(LATENCY_BUCKETS)
+            latency.observe(seconds)
+            histogram = self._queries.get(endpoint)
+            if histogram is None:
+                histogram = self._queries[endpoint] = Histogram(QUERY_COUNT_BUCKETS)
+            histogram.observe(queries)
+            self._query_seconds[endpoint] += query_seconds
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format """
+        with self._lock:
+            lines = metric_header('promotions_http_requests_total', 'counter',
+                                  'Requests served by endpoint, method and status')
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append('promotions_http_requests_total{} {}'.format(format_labels(
+                    (('endpoint', endpoint), ('method', method), ('status', str(status)))),
+                                                                          count))
+            lines += metric_header('promotions_http_request_duration_seconds', 'histogram',
+                                   'Request latency by endpoint and method')
+            for (endpoint, method), histogram in sorted(self._latency.items()):
+                lines += histogram.samples('promotions_http_request_duration_seconds',
+                                           (('endpoint', endpoint), ('method', method)))
+            lines += metric_header('promotions_db_queries_per_request', 'histogram',
+                                   'SQL queries run by each request')
+            for endpoint, histogram in sorted(self._queries.items()):
+                lines += histogram.samples('promotions_db_queries_per_request',
+                                           (('endpoint', endpoint),))
+            lines += metric_header('promotions_db_query_seconds_total', 'counter',
+                                   'Time spent running SQL queries by endpoint')
+            for endpoint, seconds in sorted(self._query_seconds.items()):
+                lines.append('promotions_db_query_seconds_total{} {}'.format(
+                    format_labels((('endpoint', endpoint),)), repr(seconds)))
+        return lines
+
+
+def format_labels(labels):
+    """ Formats (name, value) pairs as a Prometheus label set """
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def metric_header(name, metric_type, description):
+    """ Returns the HELP and TYPE lines of a metric """
+    return ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, metric_type)]
+
+
+def gauges(prefix, stats, description):
+    """ Returns a gauge for each numeric value of a statistics dictionary """
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            name = '{}_{}'.format(prefix, key)
+            lines += metric_header(name, 'gauge', '{} {}'.format(description, key))
+            lines.append('{} {}'.format(name, repr(value) if isinstance(value, float) else value))
+    return lines
+
+
+request_metrics = RequestMetrics()
+
+
+######################################################################
+#  S Q L   Q U E R Y   T R A C K I N G
+######################################################################
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context():
+        context.metrics_started = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is not None and has_request_context():
+        elapsed = time.time() - started
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_query_seconds = g.get('db_query_seconds', 0.0) + elapsed
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.add(statement, elapsed)
@@ -19,6 +19,8 @@ All of the models are stored in this module
 Models
 ------
 Promotion - A Promotion used in the eCommerce Site
+Redemption - A redemption of a Promotion, in an append-only log
+IdempotencyKey - An Idempotency-Key sent with a request, and its response
 
 Attributes:
 -----------
@@ -26,15 +28,48 @@ promotion_id (integer) - the id of the promotion
 name (string) - the name of the promotion
 product_id (integer) - the id of the product associated with the promotion
 discount_ratio (float) - the discount ratio
+start_date (datetime) - when the promotion starts, None if it always did
+end_date (datetime) - when the promotion ends, None if it never does
+max_redemptions (integer) - the most times it can be redeemed, None if unlimited
+rate_limit (integer) - the most redemptions per rate_period, None if unlimited
+rate_period (integer) - the length in seconds of the rate_limit windows
 """
 import logging
+import numbers
+import operator
 import threading
+import time
+from datetime import datetime
+import sqlalchemy
 from flask_sqlalchemy import SQLAlchemy
-from . import db
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import NotFound, Conflict
+from . import app, db
+from .cache import LRUCache
+from .encoding import EncodedDict
+from .best_promotions import BestPromotionIndex
+from .active_promotions import ActivePromotionIndex
+from .validation import Field, Schema, INT_MAX, describe, format_datetime
+
+# Serialized promotions by promotion_id, kept in step by every write below
+promotion_cache = LRUCache(app.config['PROMOTION_CACHE_SIZE'],
+                           app.config['PROMOTION_CACHE_TTL'])
+
+# Stored for validity windows without a start or an end, so the active
+# promotions are found with two range conditions on an index
+OPEN_START = datetime(1000, 1, 1)
+OPEN_END = datetime(9999, 12, 31, 23, 59, 59)
+
+# Length of the rate_limit windows of a promotion that doesn't set one
+DEFAULT_RATE_PERIOD = 3600
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
-    pass
+
+    def __init__(self, message='', errors=None):
+        Exception.__init__(self, message)
+        self.errors = errors  # error messages by field name, if any
 
 
 class Promotion(db.Model):
@@ -48,12 +83,33 @@ class Promotion(db.Model):
 
     # Table Schema
     promotion_id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
+    name = db.Column(db.String(63), index=True)
     product_id = db.Column(db.Integer)
-    discount_ratio = db.Column(db.Integer)
+    discount_ratio = db.Column(db.Integer, index=True)
     counter = db.Column(db.Integer)
-    # start_date = db.Column(db.DateTime)
-    # end_date = db.Column(db.DateTime)
+    # bumped by every write of the other columns but counter
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    # the validity window, from start_date (included) to end_date (excluded)
+    start_date = db.Column(db.DateTime, nullable=False, default=OPEN_START,
+                           server_default=str(OPEN_START))
+    end_date = db.Column(db.DateTime, nullable=False, default=OPEN_END,
+                         server_default=str(OPEN_END))
+    # optional caps on the redemptions, checked by the UPDATE that counts them
+    max_redemptions = db.Column(db.Integer)
+    rate_limit = db.Column(db.Integer)
+    rate_period = db.Column(db.Integer, nullable=False, default=DEFAULT_RATE_PERIOD,
+                            server_default=str(DEFAULT_RATE_PERIOD))
+    # the current rate window, its start in epoch seconds and its redemptions
+    rate_window_start = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    rate_counter = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # product_id lookups use the leading column of the composite index
+    __table_args__ = (
+        db.Index('ix_promotion_product_id_discount_ratio', 'product_id', 'discount_ratio'),
+        db.Index('ix_promotion_start_date_end_date', 'start_date', 'end_date'),
+    )
+    # updates and deletes only match the row at the version that was read
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Promotion %r, %r, %r>' % (self.name, self.product_id, self.discount_ratio)
@@ -64,13 +120,49 @@ class Promotion(db.Model):
         """
         if not self.promotion_id:
             self.counter = 0
+            # unset caps are inserted as NULL rather than reloaded after the commit
+            for key in ('max_redemptions', 'rate_limit'):
+                if key not in self.__dict__:
+                    setattr(self, key, None)
             db.session.add(self)
+        try:
+            db.session.flush()
+        except StaleDataError:
+            db.session.rollback()
+            raise Conflict("Promotion with id '{}' was changed by another request."
+                           .format(self.promotion_id))
+        # the flushed values are what was committed, so they are put back
+        # after the commit expires them instead of reloading the row
+        flushed = dict((key, self.__dict__[key]) for key in FIELDS if key in self.__dict__)
         db.session.commit()
+        for key, value in flushed.items():
+            set_committed_value(self, key, value)
+        promotion_cache.invalidate(self.promotion_id)
+        best_promotions.promotion_saved(self.promotion_id, self.product_id, self.discount_ratio,
+                                        self.start_date, self.end_date, datetime.utcnow())
+        active_promotions.promotion_saved(self.promotion_id, self.product_id)
 
     def delete(self):
         """ Removes a Promotion from the data store """
+        promotion_id = self.promotion_id
         db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise Conflict("Promotion with id '{}' was changed by another request."
+                           .format(promotion_id))
+        promotion_cache.invalidate(promotion_id)
+        best_promotions.promotion_removed(promotion_id)
+        active_promotions.promotion_removed(promotion_id)
+
+    def check_version(self, version):
+        """ Raises Conflict unless the Promotion is still at the expected version """
+        if not isinstance(version, numbers.Integral) or isinstance(version, bool):
+            raise DataValidationError('Invalid promotion: version must be an integer')
+        if version != self.version:
+            raise Conflict("Promotion with id '{}' is at version {}, not {}."
+                           .format(self.promotion_id, self.version, version))
 
     def serialize(self):
         """ Serializes a Promotion into a dictionary """
@@ -78,7 +170,13 @@ class Promotion(db.Model):
                 "name": self.name,
                 "product_id": self.product_id,
                 "discount_ratio": self.discount_ratio,
-                "counter": self.counter}
+                "counter": self.counter,
+                "version": self.version,
+                "start_date": serialize_date(self.start_date),
+                "end_date": serialize_date(self.end_date),
+                "max_redemptions": self.max_redemptions,
+                "rate_limit": self.rate_limit,
+                "rate_period": self.rate_period}
 
     def deserialize(self, data):
         """
@@ -87,25 +185,15 @@ class Promotion(db.Model):
         Args:
             data (dict): A dictionary containing the Promotion data
         """
-        if not isinstance(data, dict):
-            raise DataValidationError('Invalid promotion: body of request contained bad or no data')
-        try:
-            new_name = "" + data['name']
-            new_product_id = 0 + data['product_id']
-            new_discount_ratio = 0 + data['discount_ratio']
-            if new_discount_ratio < 0 or new_discount_ratio > 100:
-                raise DataValidationError('Invalid promotion: discount_ratio out of range'\
-                                          'expecting value between 0 to 100')
-            self.name = new_name
-            self.product_id = new_product_id
-            self.discount_ratio = new_discount_ratio
-            # self.start_date = data['start_date']
-            # self.end_date = data['end_date']
-        except KeyError as error:
-            raise DataValidationError('Invalid promotion: missing ' + error.args[0])
-        except TypeError as error:
-            raise DataValidationError('Invalid promotion: body of request contained' \
-                                      'bad or no data')
+        values = Promotion.validate(data)
+        self.name = values['name']
+        self.product_id = values['product_id']
+        self.discount_ratio = values['discount_ratio']
+        self.start_date = values.get('start_date', OPEN_START)
+        self.end_date = values.get('end_date', OPEN_END)
+        self.max_redemptions = values.get('max_redemptions')
+        self.rate_limit = values.get('rate_limit')
+        self.rate_period = values.get('rate_period', DEFAULT_RATE_PERIOD)
         return self
 
     def deserialize_partial(self, data):
@@ -115,55 +203,355 @@ class Promotion(db.Model):
         Args:
             data (dict): A dictionary containing the partial Promotion data
         """
+        values = Promotion.validate(data, partial=True)
+        Promotion.check_window(values.get('start_date', self.start_date),
+                               values.get('end_date', self.end_date))
+        for name, value in values.items():
+            setattr(self, name, value)
+        promotion_cache.invalidate(self.promotion_id)
+        return self
+
+    @staticmethod
+    def validate(data, partial=False):
+        """
+        Validates a Promotion payload against PROMOTION_SCHEMA
+
+        Args:
+            data (dict): A dictionary containing the Promotion data
+            partial (bool): only validate the fields that are present, of
+                which there must be at least one
+
+        Returns the valid field values, or raises a DataValidationError
+        with the errors of every invalid field
+        """
         if not isinstance(data, dict):
             raise DataValidationError('Invalid promotion: body of request contained bad or no data')
+        values, errors = PROMOTION_SCHEMA.validate(data, partial)
+        if errors:
+            raise DataValidationError('Invalid promotion: ' + describe(errors), errors)
+        if not values:
+            raise DataValidationError('Invalid promotion: missing update data')
+        # a null date leaves that side of the window open
+        if values.get('start_date', OPEN_START) is None:
+            values['start_date'] = OPEN_START
+        if values.get('end_date', OPEN_END) is None:
+            values['end_date'] = OPEN_END
+        Promotion.check_window(values.get('start_date'), values.get('end_date'))
+        return values
+
+    @staticmethod
+    def check_window(start_date, end_date):
+        """ Raises a DataValidationError unless end_date is after start_date """
+        if start_date is not None and end_date is not None and end_date <= start_date:
+            raise DataValidationError('Invalid promotion: end_date must be after start_date',
+                                      {'end_date': 'must be after start_date'})
+
+    @staticmethod
+    def bulk_create(payloads, chunk_size=1000, atomic=False, return_ids=True):
+        """
+        Validates and inserts many Promotions at once
+
+        Valid promotions are inserted chunk_size at a time, committing
+        after each chunk, or in a single transaction when atomic is set. In
+        atomic mode a single invalid payload rejects the whole batch.
+
+        Each chunk is a single multi-row INSERT, and the promotion ids are
+        worked out from the id the database reports for it when the ones
+        of a multi-row INSERT are known to be consecutive (see id_step).
+        Otherwise the rows are inserted one by one to fetch their ids.
+        Without return_ids the rows go out as one executemany per chunk and
+        promotion ids are not reported.
+
+        Args:
+            payloads (list): dictionaries containing the Promotion data
+
+        Returns a list with a dictionary per payload holding either the
+        new promotion_id or the validation error
+        """
+        results = []
+        mappings = []
+        for index, data in enumerate(payloads):
+            try:
+                mapping = Promotion.validate(data)
+            except DataValidationError as error:
+                result = {"index": index, "error": str(error)}
+                if error.errors:
+                    result["errors"] = error.errors
+                results.append(result)
+                continue
+            mapping.setdefault('start_date', OPEN_START)
+            mapping.setdefault('end_date', OPEN_END)
+            mapping.setdefault('max_redemptions', None)
+            mapping.setdefault('rate_limit', None)
+            mapping.setdefault('rate_period', DEFAULT_RATE_PERIOD)
+            mapping.update(counter=0, version=1)
+            mappings.append(mapping)
+            results.append({"index": index, "promotion": mapping})
+        if atomic and len(mappings) != len(results):
+            errors = [result for result in results if 'error' in result]
+            raise DataValidationError('Invalid promotions: {} of {} payloads are invalid, '
+                                      'first error at index {}: {}'.format(
+                                          len(errors), len(results),
+                                          errors[0]['index'], errors[0]['error']))
+        Promotion.logger.info('Bulk creating %s Promotions', len(mappings))
         try:
-            count = 0
-            if 'name' in data:
-                new_name = "" + data['name']
-                count = count + 1
-            if 'product_id' in data:
-                new_product_id = 0 + data['product_id']
-                count = count + 1
-
-            if 'discount_ratio' in data:
-                new_discount_ratio = 0 + data['discount_ratio']
-                if new_discount_ratio < 0 or new_discount_ratio > 100:
-                    raise DataValidationError('Invalid promotion: discount_ratio out of range'\
-                                          'expecting value between 0 to 100')
-                count = count + 1
-
-            if count == 0:
-                raise DataValidationError('Invalid promotion: missing update data')
-
-            if 'name' in data:
-                self.name = new_name
-            if 'product_id' in data:
-                self.product_id = new_product_id
-            if 'discount_ratio' in data:
-                self.discount_ratio = new_discount_ratio
-
-        except TypeError as error:
-            raise DataValidationError('Invalid promotion: body of request contained' \
-                                      'bad or no data')
-        return self
+            step = Promotion.id_step() if return_ids else None
+            for start in range(0, len(mappings), chunk_size):
+                chunk = mappings[start:start + chunk_size]
+                if step is None:
+                    db.session.bulk_insert_mappings(Promotion, chunk, return_defaults=return_ids)
+                else:
+                    Promotion._insert_chunk(chunk, step)
+                if not atomic:
+                    db.session.commit()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if not return_ids:
+            best_promotions.clear()
+            active_promotions.clear()
+        now = datetime.utcnow()
+        for result in results:
+            mapping = result.pop('promotion', None)
+            if mapping is not None:
+                result['promotion_id'] = mapping.get('promotion_id')
+                if return_ids:
+                    best_promotions.promotion_saved(mapping['promotion_id'], mapping['product_id'],
+                                                    mapping['discount_ratio'],
+                                                    mapping['start_date'], mapping['end_date'],
+                                                    now)
+                    active_promotions.promotion_saved(mapping['promotion_id'],
+                                                      mapping['product_id'])
+        return results
+
+    @staticmethod
+    def id_step():
+        """ Returns the step between the ids of a multi-row INSERT or None
+
+        The ids of a multi-row INSERT are consecutive, auto_increment_increment
+        apart on MySQL, as long as the table lock held while inserting keeps
+        other inserts from taking ids in between. MySQL's interleaved
+        innodb_autoinc_lock_mode doesn't, and neither may other databases,
+        which get None.
+        """
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            return 1
+        if dialect == 'mysql':
+            step, lock_mode = db.session.execute(
+                'SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode').first()
+            return None if int(lock_mode) == 2 else int(step)
+        return None
+
+    @staticmethod
+    def _insert_chunk(mappings, step):
+        """ Inserts mappings with one statement and sets their promotion_id """
+        fields = [field for field in FIELDS if field != 'promotion_id']
+        key = (db.engine.dialect.name, len(mappings))
+        statement = _multi_row_inserts.get(key)
+        if statement is None:
+            # compiling thousands of bind parameters costs more than the insert
+            statement = Promotion.__table__.insert().values(
+                [dict((field, sqlalchemy.bindparam('{}_{}'.format(field, row)))
+                      for field in fields) for row in range(len(mappings))]) \
+                .compile(dialect=db.engine.dialect)
+            _multi_row_inserts[key] = statement
+        params = {}
+        for row, mapping in enumerate(mappings):
+            for field in fields:
+                params['{}_{}'.format(field, row)] = mapping.get(field)
+        result = db.session.connection().execute(statement, params)
+        # MySQL reports the id of the first row and SQLite the one of the last
+        first = result.lastrowid
+        if db.engine.dialect.name == 'sqlite':
+            first -= step * (len(mappings) - 1)
+        for offset, mapping in enumerate(mappings):
+            mapping['promotion_id'] = first + step * offset
 
     @staticmethod
     def remove_all():
+        """ Removes all Promotions and recreates the tables """
         db.drop_all()
         db.create_all()
+        promotion_cache.clear()
+        best_promotions.clear()
+        active_promotions.clear()
 
     @staticmethod
     def init_db():
         """ Initializes the database session """
         Promotion.logger.info('Initializing database')
         db.create_all()  # make our sqlalchemy tables
+        Promotion.create_columns()
+        Promotion.create_indexes()
+
+    @staticmethod
+    def create_columns():
+        """ Adds any columns missing from an existing promotion table """
+        table = Promotion.__table__
+        existing = set(column['name'] for column in
+                       sqlalchemy.inspect(db.engine).get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                Promotion.logger.info('Adding column %s', column.name)
+                definition = sqlalchemy.schema.CreateColumn(column) \
+                    .compile(dialect=db.engine.dialect)
+                db.engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(table.name, definition))
 
     @staticmethod
-    def all():
-        """ Returns all of the Promotions in the database """
+    def create_indexes():
+        """ Creates any indexes missing from an existing promotion table """
+        table = Promotion.__table__
+        existing = set(index['name'] for index in
+                       sqlalchemy.inspect(db.engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                Promotion.logger.info('Creating index %s', index.name)
+                index.create(bind=db.engine)
+
+    @staticmethod
+    def all(after_id=None, limit=None):
+        """ Returns all of the Promotions in the database
+
+        Args:
+            after_id (Integer): only return Promotions with a larger promotion_id
+            limit (Integer): the maximum number of Promotions to return
+        """
         Promotion.logger.info('Processing all Promotions')
-        return Promotion.query.all()
+        return Promotion.paginate(Promotion.query, after_id, limit).all()
+
+    @staticmethod
+    def search(criteria, sort='promotion_id', after_id=None, after_value=None, limit=None,
+               fields=None):
+        """ Returns the Promotions matching every criterion
+
+        Args:
+            criteria (dict): values by the keys of SEARCH_CRITERIA, where the
+                _min and _max keys are inclusive range bounds
+            sort (string): a field of SORT_FIELDS, prefixed by - for
+                descending order; promotion_id breaks ties
+            after_id (Integer): the last promotion_id of the previous page
+            after_value: the sort field value of that promotion, needed
+                when sorting by anything but promotion_id
+            limit (Integer): the page size
+            fields (list): only select these fields of FIELDS and return
+                rows of them instead of Promotions
+        """
+        Promotion.logger.info('Processing search for %s sorted by %s ...', criteria, sort)
+        query = Promotion.query
+        for key, value in criteria.items():
+            if key not in SEARCH_CRITERIA:
+                raise DataValidationError('Invalid query: unknown field ' + key)
+            field, compare = SEARCH_CRITERIA[key]
+            if field is None:
+                query = query.filter(compare(value))
+            else:
+                query = query.filter(compare(getattr(Promotion, field), value))
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field not in SORT_FIELDS:
+            raise DataValidationError('Invalid query: cannot sort by ' + field)
+        column = getattr(Promotion, field)
+        if field == 'promotion_id':
+            if after_id is not None:
+                query = query.filter(column < after_id if descending else column > after_id)
+            query = query.order_by(column.desc() if descending else column)
+        else:
+            if after_id is not None:
+                query = query.filter(Promotion._after(column, descending, after_value, after_id))
+            query = query.order_by(column.desc() if descending else column,
+                                   Promotion.promotion_id)
+        if limit is not None:
+            query = query.limit(limit)
+        if fields:
+            query = query.with_entities(*Promotion.columns(fields))
+        return query
+
+    @staticmethod
+    def columns(fields):
+        """ Returns the columns of a list of FIELDS """
+        for field in fields:
+            if field not in FIELDS:
+                raise DataValidationError('Invalid query: unknown field ' + field)
+        return [getattr(Promotion, field) for field in fields]
+
+    @staticmethod
+    def _after(column, descending, value, promotion_id):
+        """ Keyset condition for the rows after (value, promotion_id)
+
+        NULLs sort before every value, as they do in MySQL and SQLite.
+        """
+        same_value_after = sqlalchemy.and_(
+            column.is_(None) if value is None else column == value,
+            Promotion.promotion_id > promotion_id)
+        if value is None:
+            if descending:
+                return same_value_after
+            return sqlalchemy.or_(same_value_after, column.isnot(None))
+        if descending:
+            return sqlalchemy.or_(column < value, same_value_after, column.is_(None))
+        return sqlalchemy.or_(column > value, same_value_after)
+
+    @staticmethod
+    def iter_all(batch_size=1000):
+        """ Iterates over every Promotion in promotion_id order
+
+        Rows are fetched batch_size at a time through a server side cursor
+        (where the driver supports one), so memory use doesn't grow with
+        the size of the table.
+        """
+        Promotion.logger.info('Streaming all Promotions')
+        return Promotion.query.order_by(Promotion.promotion_id).yield_per(batch_size)
+
+    @staticmethod
+    def iter_rows(batch_size=1000, fields=None):
+        """ Iterates over every Promotion in promotion_id order as dictionaries
+
+        Like iter_all but runs Core SELECTs, one keyset page of batch_size
+        rows at a time, and never builds Promotion instances.
+        """
+        Promotion.logger.info('Streaming all Promotion rows')
+        fields = fields or FIELDS
+        serialize_row = row_serializer(fields)
+        table = Promotion.__table__
+        columns = [table.c[field] for field in fields] + [table.c.promotion_id.label('cursor')]
+        after_id = None
+        while True:
+            query = sqlalchemy.select(columns).order_by(table.c.promotion_id).limit(batch_size)
+            if after_id is not None:
+                query = query.where(table.c.promotion_id > after_id)
+            rows = db.session.execute(query).fetchall()
+            for row in rows:
+                yield serialize_row(row)
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1]['cursor']
+
+    @staticmethod
+    def serialize_rows(query, fields):
+        """ Runs a query made by search(fields=...) and returns its rows as dictionaries
+
+        The statement is executed through Core, so no Promotion instances
+        are built and nothing is added to the session's identity map.
+        """
+        serialize_row = row_serializer(fields)
+        return [serialize_row(row) for row in db.session.execute(query.statement)]
+
+    @staticmethod
+    def paginate(query, after_id=None, limit=None):
+        """ Applies keyset pagination on promotion_id to a Promotion query
+
+        Args:
+            query (Query): the Promotion query to page through
+            after_id (Integer): the last promotion_id of the previous page
+            limit (Integer): the page size
+        """
+        if after_id is not None:
+            query = query.filter(Promotion.promotion_id > after_id)
+        if limit is not None:
+            query = query.order_by(Promotion.promotion_id).limit(limit)
+        return query
 
     @staticmethod
     def find(promotion_id):
@@ -173,6 +561,61 @@ class Promotion(db.Model):
         Promotion.logger.info('Processing lookup for id %s ...', promotion_id)
         return Promotion.query.get(promotion_id)
 
+    @staticmethod
+    def find_serialized(promotion_id, fields=None):
+        """ Returns a serialized Promotion by it's ID, from the cache if possible
+
+        The returned EncodedDict is shared with the cache and must not be
+        modified, so its JSON encoding is only built once.
+        If fields is given only they are returned, and a cache miss only
+        selects those columns (the result is then not cached).
+        """
+        columns = Promotion.columns(fields) if fields else None
+        result = promotion_cache.get(promotion_id)
+        if result is not None and columns:
+            return dict((field, result[field]) for field in fields)
+        if result is None and columns:
+            row = db.session.query(*columns) \
+                .filter(Promotion.promotion_id == promotion_id).first()
+            return row_serializer(fields)(row) if row else None
+        if result is None:
+            generation = promotion_cache.generation(promotion_id)
+            promotion = Promotion.find(promotion_id)
+            if not promotion:
+                return None
+            result = EncodedDict(promotion.serialize())
+            promotion_cache.set(promotion_id, result, generation)
+        return result
+
+    @staticmethod
+    def find_serialized_many(promotion_ids):
+        """ Returns the serialized Promotions of a list of IDs, from the cache if possible
+
+        The cache misses are selected by a single IN query. The Promotions
+        are returned in the order of promotion_ids, without the missing ones.
+        """
+        results = {}
+        misses = []
+        for promotion_id in promotion_ids:
+            result = promotion_cache.get(promotion_id)
+            if result is None:
+                misses.append(promotion_id)
+            else:
+                results[promotion_id] = result
+        if misses:
+            generations = dict((promotion_id, promotion_cache.generation(promotion_id))
+                               for promotion_id in misses)
+            serialize_row = row_serializer(FIELDS)
+            rows = db.session.execute(sqlalchemy.select(Promotion.columns(FIELDS))
+                                      .where(Promotion.promotion_id.in_(misses)))
+            for row in rows:
+                result = EncodedDict(serialize_row(row))
+                promotion_id = result['promotion_id']
+                promotion_cache.set(promotion_id, result, generations[promotion_id])
+                results[promotion_id] = result
+        return [results[promotion_id] for promotion_id in promotion_ids
+                if promotion_id in results]
+
     @staticmethod
     def find_or_404(promotion_id):
         """ Find a promotion_id by it's id """
@@ -180,43 +623,548 @@ class Promotion(db.Model):
         return Promotion.query.get_or_404(promotion_id)
 
     @staticmethod
-    def find_by_name(name):
+    def find_by_name(name, after_id=None, limit=None):
         """ Returns all Promotions with the given name
 
         Args:
             name (string): the name of the Promotions you want to match
+            after_id (Integer): only return Promotions with a larger promotion_id
+            limit (Integer): the maximum number of Promotions to return
         """
         Promotion.logger.info('Processing name query for %s ...', name)
-        return Promotion.query.filter(Promotion.name == name)
+        return Promotion.paginate(Promotion.query.filter(Promotion.name == name),
+                                  after_id, limit)
 
     @staticmethod
-    def find_by_product_id(product_id):
+    def find_by_product_id(product_id, after_id=None, limit=None):
         """ Returns all Promotions of a specific product
 
         Args:
             product_id (Integer): product id of the Promotions you want to match
+            after_id (Integer): only return Promotions with a larger promotion_id
+            limit (Integer): the maximum number of Promotions to return
         """
         Promotion.logger.info('Processing product_id query for %s ...', product_id)
-        return Promotion.query.filter(Promotion.product_id == product_id)
+        return Promotion.paginate(Promotion.query.filter(Promotion.product_id == product_id),
+                                  after_id, limit)
 
     @staticmethod
-    def find_by_discount_ratio(discount_ratio):
+    def find_by_discount_ratio(discount_ratio, after_id=None, limit=None):
         """ Returns all Promotions of a specific product
 
         Args:
             discount_ratio (Float): product id of the Promotions you want to match
+            after_id (Integer): only return Promotions with a larger promotion_id
+            limit (Integer): the maximum number of Promotions to return
         """
         Promotion.logger.info('Processing product_id query for %r ...', discount_ratio)
-        return Promotion.query.filter(Promotion.discount_ratio == discount_ratio)
+        return Promotion.paginate(
+            Promotion.query.filter(Promotion.discount_ratio == discount_ratio),
+            after_id, limit)
 
     @staticmethod
-    def redeem_promotion(promotion_id):
-        """ Redeem a Promotions by it's ID. Thread Safe. """
+    def redeem_promotion(promotion_id, now=None):
+        """ Redeem a Promotions by it's ID. Thread Safe.
+
+        The counter is incremented by the database in a single atomic
+        UPDATE, so concurrent redeems never lose an increment and a
+        missing promotion is detected from the affected row count
+        without reading the row first. The UPDATE only matches while
+        the promotion is under its caps, so an exhausted promotion raises
+        Conflict and is never redeemed past them.
+
+        Args:
+            now (int): the time in epoch seconds, for the rate_limit windows
+        """
         if not isinstance(promotion_id, int):
             raise DataValidationError('Invalid promotion: body of request contained bad or no data')
         Promotion.logger.info('Redeem promotion %s ...', promotion_id)
-        # If the promotion doesn't exist, 404 will be raised.
-        promotion = Promotion.find_or_404(promotion_id)
-        promotion.counter = promotion.counter + 1
-        db.session.commit()
-        return promotion
+        now = int(time.time()) if now is None else now
+        table = Promotion.__table__
+        try:
+            updated = db.session.execute(
+                Promotion.redemption(table.c.promotion_id == promotion_id, 1, now)).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if not updated:
+            refusals = Promotion.find_refusals({promotion_id: 1}, now)
+            if promotion_id not in refusals:
+                raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
+            # a promotion back within its caps was changed since the UPDATE
+            raise Conflict("Promotion with id '{}' {}.".format(
+                promotion_id, refusals[promotion_id] or 'was changed by another request'))
+        promotion_cache.invalidate(promotion_id)
+        return Promotion.query.get(promotion_id)
+
+    @staticmethod
+    def redeem_promotions(quantities, now=None):
+        """ Redeem many Promotions in one transaction. Thread Safe.
+
+        All of the counters are incremented by a single UPDATE that adds
+        each promotion's quantity through a CASE on promotion_id. If any
+        promotion would go past its caps nothing is redeemed and Conflict
+        is raised.
+
+        Args:
+            quantities (dict): the number of redemptions by promotion_id
+            now (int): the time in epoch seconds, for the rate_limit windows
+
+        Returns a dictionary of the new counters by promotion_id, which
+        leaves out the promotions that don't exist
+        """
+        if not quantities:
+            return {}
+        Promotion.logger.info('Redeem %s promotions ...', len(quantities))
+        now = int(time.time()) if now is None else now
+        promotion_ids = list(quantities)
+        table = Promotion.__table__
+        increment = sqlalchemy.case(quantities, value=table.c.promotion_id, else_=0)
+        try:
+            updated = db.session.execute(
+                Promotion.redemption(table.c.promotion_id.in_(promotion_ids),
+                                     increment, now)).rowcount
+            rows = db.session.execute(sqlalchemy.select([table.c.promotion_id, table.c.counter])
+                                      .where(table.c.promotion_id.in_(promotion_ids)))
+            counters = dict((row[0], row[1]) for row in rows)
+            if updated == len(counters):
+                db.session.commit()
+            else:
+                db.session.rollback()
+        except Exception:
+            db.session.rollback()
+            raise
+        if updated != len(counters):
+            refusals = Promotion.find_refusals(quantities, now)
+            reasons = ["promotion with id '{}' {}".format(promotion_id, refusals[promotion_id])
+                       for promotion_id in sorted(refusals) if refusals[promotion_id]]
+            raise Conflict('Promotions could not be redeemed: ' +
+                           ('; '.join(reasons) or 'they were changed by another request') + '.')
+        for promotion_id in promotion_ids:
+            promotion_cache.invalidate(promotion_id)
+        return counters
+
+    @staticmethod
+    def redemption(condition, quantity, now):
+        """ Returns the UPDATE that redeems the Promotions matching condition
+
+        The WHERE clause only matches the rows that stay within their
+        max_redemptions and rate_limit once quantity is added, so the
+        caps are checked and the counters changed by one atomic statement.
+        A rate window that has run its rate_period is restarted at now.
+
+        Args:
+            condition: which Promotions to redeem
+            quantity (int): the redemptions of each Promotion, or an
+                expression of them
+            now (int): the time in epoch seconds
+        """
+        table = Promotion.__table__
+        in_window = table.c.rate_window_start + table.c.rate_period > now
+        used = sqlalchemy.case([(in_window, table.c.rate_counter)], else_=0)
+        # MySQL assigns the columns in order and later ones see the new
+        # values, so rate_counter is computed before rate_window_start moves
+        return table.update(preserve_parameter_order=True) \
+            .where(condition) \
+            .where(sqlalchemy.or_(table.c.max_redemptions.is_(None),
+                                  table.c.counter + quantity <= table.c.max_redemptions)) \
+            .where(sqlalchemy.or_(table.c.rate_limit.is_(None),
+                                  used + quantity <= table.c.rate_limit)) \
+            .values([(table.c.counter, table.c.counter + quantity),
+                     (table.c.rate_counter, used + quantity),
+                     (table.c.rate_window_start,
+                      sqlalchemy.case([(in_window, table.c.rate_window_start)], else_=now))])
+
+    @staticmethod
+    def find_refusals(quantities, now):
+        """ Returns why each existing Promotion can't be redeemed, by promotion_id
+
+        Only used to report a refused redemption, which the UPDATE of
+        redemption() has already decided. The reason is None for a
+        Promotion that is within its caps.
+        """
+        table = Promotion.__table__
+        rows = db.session.execute(
+            sqlalchemy.select([table.c.promotion_id, table.c.counter, table.c.max_redemptions,
+                               table.c.rate_limit, table.c.rate_period,
+                               table.c.rate_window_start, table.c.rate_counter])
+            .where(table.c.promotion_id.in_(list(quantities))))
+        refusals = {}
+        for promotion_id, counter, max_redemptions, rate_limit, rate_period, \
+                window_start, rate_counter in rows:
+            quantity = quantities[promotion_id]
+            used = rate_counter if window_start + rate_period > now else 0
+            if max_redemptions is not None and counter + quantity > max_redemptions:
+                refusals[promotion_id] = 'has {} of its {} redemptions left'.format(
+                    max(max_redemptions - counter, 0), max_redemptions)
+            elif rate_limit is not None and used + quantity > rate_limit:
+                refusals[promotion_id] = \
+                    'has {} of its {} redemptions per {} seconds left'.format(
+                        max(rate_limit - used, 0), rate_limit, rate_period)
+            else:
+                refusals[promotion_id] = None
+        return refusals
+
+    @staticmethod
+    def find_counters(promotion_ids):
+        """ Returns (counter, capped) of each existing Promotion by promotion_id
+
+        A Promotion is capped if it has a max_redemptions or rate_limit.
+        """
+        if not promotion_ids:
+            return {}
+        table = Promotion.__table__
+        capped = sqlalchemy.or_(table.c.max_redemptions.isnot(None),
+                                table.c.rate_limit.isnot(None))
+        rows = db.session.execute(sqlalchemy.select([table.c.promotion_id, table.c.counter,
+                                                     capped])
+                                  .where(table.c.promotion_id.in_(list(promotion_ids))))
+        return dict((row[0], (row[1], bool(row[2]))) for row in rows)
+
+    @staticmethod
+    def bulk_update(changes, promotion_ids=None, product_id=None, chunk_size=1000):
+        """ Applies the same changes to many Promotions
+
+        The matching promotions are updated chunk_size at a time by
+        UPDATE ... WHERE promotion_id IN (...) statements, each committed
+        on its own so no transaction holds locks on the whole set. Changes
+        of only one end of the validity window skip the promotions whose
+        window it would leave empty.
+
+        Args:
+            changes (dict): the new column values, as from deserialize_partial
+            promotion_ids (list): the ids of the Promotions to update, or
+            product_id (Integer): update every Promotion of this product
+
+        Returns the number of Promotions updated and the list of the ids
+        of those skipped for their window
+        """
+        Promotion.logger.info('Bulk updating Promotions with %s', changes)
+        table = Promotion.__table__
+        guard = Promotion.window_guard(changes)
+        affected = 0
+        skipped = []
+        for chunk in Promotion._id_chunks(promotion_ids, product_id, chunk_size):
+            query = table.update().where(table.c.promotion_id.in_(chunk))
+            if guard is not None:
+                query = query.where(guard)
+            result = db.session.execute(query.values(version=table.c.version + 1, **changes))
+            if guard is not None and result.rowcount < len(chunk):
+                rows = db.session.execute(sqlalchemy.select([table.c.promotion_id])
+                                          .where(table.c.promotion_id.in_(chunk))
+                                          .where(sqlalchemy.not_(guard)))
+                skipped.extend(row[0] for row in rows)
+            db.session.commit()
+            affected += result.rowcount
+            for promotion_id in chunk:
+                promotion_cache.invalidate(promotion_id)
+        if set(changes) & set(['product_id', 'discount_ratio', 'start_date', 'end_date']):
+            best_promotions.clear()
+        if set(changes) & set(['product_id', 'start_date', 'end_date']):
+            active_promotions.clear()
+        return affected, sorted(skipped)
+
+    @staticmethod
+    def window_guard(changes):
+        """ Returns the condition of the rows whose window changes leave valid
+
+        Both ends of the window are checked against each other by
+        validate(), so only a change of one end needs the stored other end.
+        None is returned when no row can be left with an empty window.
+        """
+        if 'start_date' in changes and 'end_date' not in changes:
+            return Promotion.end_date > changes['start_date']
+        if 'end_date' in changes and 'start_date' not in changes:
+            return Promotion.start_date < changes['end_date']
+        return None
+
+    @staticmethod
+    def bulk_delete(promotion_ids=None, product_id=None, chunk_size=1000):
+        """ Removes many Promotions from the data store
+
+        Args:
+            promotion_ids (list): the ids of the Promotions to delete, or
+            product_id (Integer): delete every Promotion of this product
+
+        Returns the number of Promotions deleted and the list of the
+        targeted promotion ids, from either filter
+        """
+        Promotion.logger.info('Bulk deleting Promotions')
+        table = Promotion.__table__
+        affected = 0
+        deleted_ids = []
+        for chunk in Promotion._id_chunks(promotion_ids, product_id, chunk_size):
+            result = db.session.execute(table.delete()
+                                        .where(table.c.promotion_id.in_(chunk)))
+            db.session.commit()
+            affected += result.rowcount
+            deleted_ids.extend(chunk)
+            for promotion_id in chunk:
+                promotion_cache.invalidate(promotion_id)
+                best_promotions.promotion_removed(promotion_id)
+                active_promotions.promotion_removed(promotion_id)
+        return affected, deleted_ids
+
+    @staticmethod
+    def _id_chunks(promotion_ids, product_id, chunk_size):
+        """ Yields the targeted promotion ids chunk_size at a time
+
+        Explicit ids are split into chunks as given. A product_id filter
+        is walked with keyset pagination on promotion_id, so the chunks
+        stay correct while the rows are being changed or deleted.
+        """
+        if promotion_ids is not None:
+            promotion_ids = sorted(set(promotion_ids))
+            for start in range(0, len(promotion_ids), chunk_size):
+                yield promotion_ids[start:start + chunk_size]
+            return
+        table = Promotion.__table__
+        last_id = 0
+        while True:
+            rows = db.session.execute(sqlalchemy.select([table.c.promotion_id])
+                                      .where(table.c.product_id == product_id)
+                                      .where(table.c.promotion_id > last_id)
+                                      .order_by(table.c.promotion_id)
+                                      .limit(chunk_size))
+            chunk = [row[0] for row in rows]
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1]
+
+    @staticmethod
+    def find_best_for_product(product_id):
+        """ Returns the serialized active Promotion with the highest discount_ratio for a product
+
+        Args:
+            product_id (Integer): the product to find the best Promotion of
+        """
+        now = datetime.utcnow()
+        best = best_promotions.get(product_id, now)
+        if best is None:
+            return None
+        result = Promotion.find_serialized(best[1])
+        if result is None:
+            # deleted by another process since the product was loaded
+            best = best_promotions.reload(product_id, now)
+            if best is None:
+                return None
+            result = Promotion.find_serialized(best[1])
+        return result
+
+    @staticmethod
+    def find_best_for_products(product_ids):
+        """ Returns the best serialized Promotion of each product by product_id
+
+        Args:
+            product_ids (list): the products to find the best Promotions of
+        """
+        return dict((product_id, Promotion.find_best_for_product(product_id))
+                    for product_id in product_ids)
+
+    @staticmethod
+    def load_best(product_id, now):
+        """ Returns the best Promotion of a product active at now and when that may change
+
+        The best is (discount_ratio, promotion_id) or None, and it may change
+        at its end_date or at the next start_date of the product's Promotions.
+        """
+        row = db.session.query(Promotion.discount_ratio, Promotion.promotion_id,
+                               Promotion.end_date) \
+            .filter(Promotion.product_id == product_id) \
+            .filter(Promotion.discount_ratio.isnot(None)) \
+            .filter(Promotion.active_at(now)) \
+            .order_by(Promotion.discount_ratio.desc(), Promotion.promotion_id) \
+            .first()
+        expires = db.session.query(sqlalchemy.func.min(Promotion.start_date)) \
+            .filter(Promotion.product_id == product_id) \
+            .filter(Promotion.start_date > now).scalar()
+        if row is None:
+            return None, expires
+        if expires is None or row[2] < expires:
+            expires = row[2]
+        return (row[0], row[1]), expires
+
+    @staticmethod
+    def active_at(point):
+        """ Returns the condition of the Promotions active at a datetime """
+        return sqlalchemy.and_(Promotion.start_date <= point, Promotion.end_date > point)
+
+    @staticmethod
+    def find_active_for_product(product_id, point):
+        """ Returns the serialized Promotions of a product active at a datetime
+
+        The promotion_ids come from the in-memory interval trees of
+        active_promotions and the Promotions from the cache, or from one
+        query for those it misses.
+
+        Args:
+            product_id (Integer): the product to find the active Promotions of
+            point (datetime): the time they must be active at, in UTC
+        """
+        return Promotion.find_serialized_many(active_promotions.active(product_id, point))
+
+    @staticmethod
+    def load_windows(product_id):
+        """ Returns (promotion_id, start_date, end_date) of every Promotion of a product """
+        return db.session.query(Promotion.promotion_id, Promotion.start_date,
+                                Promotion.end_date) \
+            .filter(Promotion.product_id == product_id).all()
+
+    @staticmethod
+    def rebuild_best_index():
+        """ Precomputes the best Promotion of every product """
+        Promotion.logger.info('Building the best promotion index')
+        rows = db.session.query(Promotion.product_id, Promotion.discount_ratio,
+                                Promotion.promotion_id, Promotion.start_date,
+                                Promotion.end_date).yield_per(10000)
+        best_promotions.rebuild(rows, datetime.utcnow())
+
+
+# Search criteria accepted by Promotion.search: (field, comparison)
+SEARCH_CRITERIA = {
+    'name': ('name', operator.eq),
+    'product_id': ('product_id', operator.eq),
+    'discount_ratio': ('discount_ratio', operator.eq),
+    'discount_ratio_min': ('discount_ratio', operator.ge),
+    'discount_ratio_max': ('discount_ratio', operator.le),
+    'promotion_id_min': ('promotion_id', operator.ge),
+    'promotion_id_max': ('promotion_id', operator.le),
+    # a condition of the value alone, for criteria on more than one column
+    'active_at': (None, Promotion.active_at),
+}
+# Fields of a serialized Promotion, which can all be selected and sorted by
+FIELDS = ('promotion_id', 'name', 'product_id', 'discount_ratio', 'counter', 'version',
+          'start_date', 'end_date', 'max_redemptions', 'rate_limit', 'rate_period')
+SORT_FIELDS = FIELDS
+# Stored value of each end of a window when it is open
+OPEN_DATES = {'start_date': OPEN_START, 'end_date': OPEN_END}
+
+# The fields a client sends to create or update a Promotion
+PROMOTION_SCHEMA = Schema([
+    Field('name', 'string', max_length=Promotion.__table__.c.name.type.length),
+    Field('product_id', 'integer', minimum=0, maximum=INT_MAX),
+    Field('discount_ratio', 'integer', minimum=0, maximum=100),
+    Field('start_date', 'datetime', required=False, nullable=True),
+    Field('end_date', 'datetime', required=False, nullable=True),
+    Field('max_redemptions', 'integer', required=False, nullable=True,
+          minimum=0, maximum=INT_MAX),
+    Field('rate_limit', 'integer', required=False, nullable=True, minimum=0, maximum=INT_MAX),
+    Field('rate_period', 'integer', required=False, minimum=1, maximum=INT_MAX),
+])
+
+
+def serialize_date(value):
+    """ Serializes a window date, None for an open end """
+    if value is None or value == OPEN_START or value == OPEN_END:
+        return None
+    return format_datetime(value)
+
+
+def row_serializer(fields):
+    """ Returns a function that serializes a row of the columns of fields """
+    dates = [index for index, field in enumerate(fields) if field in OPEN_DATES]
+    if not dates:
+        return lambda row: dict(zip(fields, row))
+
+    def serialize_row(row):
+        values = list(row)
+        for index in dates:
+            values[index] = serialize_date(values[index])
+        return dict(zip(fields, values))
+    return serialize_row
+
+
+class Redemption(db.Model):
+    """
+    Class that represents a Redemption of a Promotion
+
+    The redemption table is an append-only log of events. It is written
+    in batches by the RedemptionLog and only read to aggregate it.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Table Schema
+    redemption_id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'),
+                              primary_key=True)
+    promotion_id = db.Column(db.Integer, nullable=False)
+    # in epoch seconds, so time buckets are integer arithmetic in any database
+    redeemed_at = db.Column(db.BigInteger, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    order_id = db.Column(db.String(63))
+    customer_id = db.Column(db.String(63))
+
+    __table_args__ = (
+        db.Index('ix_redemption_promotion_id_redeemed_at', 'promotion_id', 'redeemed_at'),
+        db.Index('ix_redemption_redeemed_at', 'redeemed_at'),
+    )
+
+    def __repr__(self):
+        return '<Redemption %r of %r>' % (self.quantity, self.promotion_id)
+
+    @staticmethod
+    def aggregate(since, until, bucket, promotion_ids=None):
+        """ Returns the number of redemptions per Promotion per time bucket
+
+        Args:
+            since (int): the start of the time range in epoch seconds (included)
+            until (int): the end of the time range in epoch seconds (excluded)
+            bucket (int): the length of the buckets in seconds, which
+                start at the multiples of it
+            promotion_ids (list): only count these Promotions
+
+        Returns a list of (promotion_id, bucket start, redemptions) of the
+        buckets with redemptions, by promotion_id and bucket start
+        """
+        Redemption.logger.info('Aggregating redemptions in buckets of %s seconds', bucket)
+        table = Redemption.__table__
+        bucket_start = (table.c.redeemed_at - table.c.redeemed_at % bucket).label('bucket_start')
+        query = sqlalchemy.select([table.c.promotion_id, bucket_start,
+                                   sqlalchemy.func.sum(table.c.quantity)]) \
+            .where(table.c.redeemed_at >= since) \
+            .where(table.c.redeemed_at < until)
+        if promotion_ids:
+            query = query.where(table.c.promotion_id.in_(promotion_ids))
+        query = query.group_by(table.c.promotion_id, bucket_start) \
+            .order_by(table.c.promotion_id, bucket_start)
+        return [(row[0], row[1], int(row[2])) for row in db.session.execute(query)]
+
+# Compiled multi-row INSERTs of bulk_create by (dialect, number of rows)
+_multi_row_inserts = {}
+
+# Best promotion of each product, kept in step by the writes above
+best_promotions = BestPromotionIndex(Promotion.load_best, app.config['PROMOTION_CACHE_TTL'])
+
+# Validity windows of the promotions of each product, kept in step by the writes above
+active_promotions = ActivePromotionIndex(Promotion.load_windows,
+                                         app.config['PROMOTION_CACHE_TTL'])
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents an Idempotency-Key sent with a request
+
+    A key is written in the same transaction as the first change its
+    request commits, and its response is added once it is known. It is
+    written and read by the IdempotencyStore.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Table Schema
+    # sha1 of the key, which is too long for an index in every MySQL charset
+    key_digest = db.Column(db.String(40), primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False)
+    # in epoch seconds
+    created_at = db.Column(db.BigInteger, nullable=False)
+    # None until the response of the request is recorded
+    status = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary(16777215))
+
+    __table_args__ = (
+        db.Index('ix_idempotency_key_created_at', 'created_at'),
+    )
+
+    def __repr__(self):
+        return '<IdempotencyKey %r>' % (self.key_digest)
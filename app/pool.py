@@ -0,0 +1,135 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Connection Pool module
+
+InstrumentedQueuePool is the SQLAlchemy QueuePool with counters for how
+long checkouts wait and how often they time out, and an optional ping of
+every connection on checkout so connections dropped by the database are
+replaced instead of failing the request.
+
+PooledSQLAlchemy installs it for every database but SQLite and passes it
+the SQLALCHEMY_POOL_PRE_PING setting.
+"""
+import threading
+import time
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(object):
+    """ Thread safe counters of connection pool checkouts """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self._lock:
+            self.checkouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.timeouts = 0
+            self.disconnects = 0
+
+    def checked_out(self, wait):
+        """ Records a checkout that waited wait seconds """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def timed_out(self):
+        """ Records a checkout that gave up waiting for a connection """
+        with self._lock:
+            self.timeouts += 1
+
+    def disconnected(self):
+        """ Records a stale connection found by a ping """
+        with self._lock:
+            self.disconnects += 1
+
+    def stats(self, pool=None):
+        """ Returns the counters, and the state of pool if it is a QueuePool """
+        with self._lock:
+            stats = {"checkouts": self.checkouts,
+                     "wait_seconds": self.wait_seconds,
+                     "max_wait_seconds": self.max_wait_seconds,
+                     "timeouts": self.timeouts,
+                     "disconnects": self.disconnects}
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(),
+                         max_overflow=pool._max_overflow,
+                         in_use=pool.checkedout(),
+                         idle=pool.checkedin(),
+                         overflow=max(0, pool.overflow()))
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Checkout listener that replaces connections the database has dropped """
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        pool_metrics.disconnected()
+        # the pool discards this connection and retries with a new one
+        raise exc.DisconnectionError()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that records checkout waits and can ping on checkout """
+
+    def __init__(self, creator, pre_ping=False, **kwargs):
+        QueuePool.__init__(self, creator, **kwargs)
+        # recreate() copies the listeners of the old pool
+        if pre_ping and not event.contains(self, 'checkout', ping_connection):
+            event.listen(self, 'checkout', ping_connection)
+
+    def connect(self):
+        return self._timed_checkout(QueuePool.connect)
+
+    def unique_connection(self):
+        # Engine.connect(), begin() and execute() check out through here
+        return self._timed_checkout(QueuePool.unique_connection)
+
+    def _timed_checkout(self, checkout):
+        """ Checks out a connection with checkout, recording its wait or timeout """
+        start = time.time()
+        try:
+            connection = checkout(self)
+        except exc.TimeoutError:
+            pool_metrics.timed_out()
+            raise
+        pool_metrics.checked_out(time.time() - start)
+        return connection
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy that pools connections with InstrumentedQueuePool """
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername != 'sqlite':
+            options['poolclass'] = InstrumentedQueuePool
+            options['pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
@@ -0,0 +1,78 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQL Profiler module
+
+An SqlProfile holds the text and time of every SQL statement a request
+ran. The server attaches one to a sample of the requests when
+SQL_PROFILE_ENABLED is set, and then reports the profile in a
+Server-Timing header and logs the requests that are slow, that run too
+many statements, or that run the same statement over and over (N+1).
+"""
+import random
+from collections import Counter
+
+
+class SqlProfile(object):
+    """ The SQL statements run by one request """
+
+    def __init__(self):
+        self.statements = []   # (statement, seconds)
+
+    def add(self, statement, seconds):
+        """ Records a statement that ran for seconds """
+        self.statements.append((statement, seconds))
+
+    @property
+    def count(self):
+        """ The number of statements run """
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        """ The time spent running statements """
+        return sum(seconds for _, seconds in self.statements)
+
+    def repeated(self, threshold):
+        """ Returns (statement, times) for the statements run threshold times or more """
+        counts = Counter(statement for statement, _ in self.statements)
+        return [(statement, times) for statement, times in counts.most_common()
+                if times >= threshold]
+
+    def server_timing(self, total):
+        """ Returns the Server-Timing header of a request that took total seconds """
+        return 'db;dur={:.2f};desc="{} queries", total;dur={:.2f}'.format(
+            self.seconds * 1000, self.count, total * 1000)
+
+    def problems(self, total, slow_ms, max_queries, repeated_queries):
+        """ Returns why the request should be logged, empty if it shouldn't """
+        problems = []
+        if total * 1000 >= slow_ms:
+            problems.append('took {:.1f}ms'.format(total * 1000))
+        if self.count > max_queries:
+            problems.append('ran {} queries'.format(self.count))
+        for statement, times in self.repeated(repeated_queries):
+            problems.append('ran {} times: {}'.format(times, statement))
+        return problems
+
+    def report(self):
+        """ Returns one line per statement with its time """
+        return ['  {:.2f}ms {}'.format(seconds * 1000, ' '.join(statement.split()))
+                for statement, seconds in self.statements]
+
+
+def sampled(rate):
+    """ Returns True for a rate fraction of the calls """
+    return rate >= 1 or random.random() < rate
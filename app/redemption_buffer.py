@@ -0,0 +1,218 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Redemption Buffer module
+
+This module holds redemptions in memory and writes them to the
+promotion counter column in batches (write-behind).
+
+Redemptions are spread over several shards picked by the calling thread,
+so concurrent requests for the same promotion do not fight over one lock.
+A background thread flushes the shards every flush_interval seconds, or
+sooner once a shard holds flush_threshold / shards pending redemptions,
+and a final flush runs when the process exits.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import select
+from . import db
+from .models import Promotion, promotion_cache
+from .flusher import BackgroundFlusher
+
+
+class _Shard(object):
+    """ One lock-protected slice of the pending redemption counts """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.total = 0
+
+
+class RedemptionBuffer(BackgroundFlusher):
+    """ Sharded in-process buffer of pending promotion redemptions """
+    logger = logging.getLogger(__name__)
+    thread_name = 'redemption-flush'
+
+    def __init__(self, shards=16, flush_interval=1.0, flush_threshold=1000, read_retries=3):
+        BackgroundFlusher.__init__(self, flush_interval)
+        self.shard_threshold = max(1, flush_threshold // shards)
+        self.read_retries = read_retries
+        self._shards = [_Shard() for _ in range(shards)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._epoch = 0           # odd while a flush is moving counts to the database
+
+    def _shard(self):
+        """ Returns the shard used by the calling thread, given out round-robin """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            # thread idents are aligned addresses, so they can't pick a shard
+            shard = self._shards[next(self._next_shard) % len(self._shards)]
+            self._local.shard = shard
+        return shard
+
+    def add(self, promotion_id, count=1):
+        """ Records count pending redemptions of a promotion """
+        shard = self._shard()
+        with shard.lock:
+            shard.counts[promotion_id] += count
+            shard.total += count
+            full = shard.total >= self.shard_threshold
+        self.start()
+        if full:
+            self.wakeup()
+
+    def pending(self, promotion_id):
+        """ Returns the number of unflushed redemptions of a promotion """
+        total = 0
+        for shard in self._shards:
+            with shard.lock:
+                total += shard.counts.get(promotion_id, 0)
+        return total
+
+    def pending_counts(self):
+        """ Returns a snapshot of all unflushed redemptions by promotion id """
+        totals = defaultdict(int)
+        for shard in self._shards:
+            with shard.lock:
+                for promotion_id, count in shard.counts.items():
+                    totals[promotion_id] += count
+        return totals
+
+    @property
+    def epoch(self):
+        """ The flush epoch, to be taken before reading counters for add_pending() """
+        return self._epoch
+
+    def add_pending(self, counters, epoch):
+        """
+        Returns stored counters by promotion id plus their pending redemptions
+
+        counters are the stored counters the caller already read, from the
+        session or the promotion cache, after taking epoch. No query runs
+        unless a flush overlapped that read, which may then have missed the
+        redemptions the flush moved: the counters are read again outside the
+        session, at most read_retries times, and the last read is used if
+        flushes keep overlapping.
+        """
+        pending = self.pending_counts()
+        retries = 0
+        while (epoch % 2 or epoch != self._epoch) and retries < self.read_retries:
+            retries += 1
+            if self._epoch % 2:
+                time.sleep(0.001)    # give the running flush time to finish
+            epoch = self._epoch
+            counters = self._load(list(counters))
+            pending = self.pending_counts()
+        return dict((promotion_id, (counter or 0) + pending.get(promotion_id, 0))
+                    for promotion_id, counter in counters.items())
+
+    @staticmethod
+    def _load(promotion_ids):
+        """ Returns the stored counters by promotion id, read outside the session """
+        table = Promotion.__table__
+        with db.engine.connect() as conn:
+            return dict(conn.execute(select([table.c.promotion_id, table.c.counter])
+                                     .where(table.c.promotion_id.in_(promotion_ids)))
+                        .fetchall())
+
+    def discard(self, promotion_id):
+        """ Drops the pending redemptions of a deleted promotion """
+        for shard in self._shards:
+            with shard.lock:
+                shard.total -= shard.counts.pop(promotion_id, 0)
+
+    def clear(self):
+        """ Drops every pending redemption """
+        for shard in self._shards:
+            with shard.lock:
+                shard.counts = defaultdict(int)
+                shard.total = 0
+
+    def _drain(self):
+        """ Empties the shards and returns the merged counts """
+        totals = defaultdict(int)
+        for shard in self._shards:
+            with shard.lock:
+                counts = shard.counts
+                shard.counts = defaultdict(int)
+                shard.total = 0
+            for promotion_id, count in counts.items():
+                totals[promotion_id] += count
+        return totals
+
+    def _restore(self, totals):
+        """ Puts drained counts back after a failed flush """
+        shard = self._shard()
+        with shard.lock:
+            for promotion_id, count in totals.items():
+                shard.counts[promotion_id] += count
+                shard.total += count
+
+    def flush(self):
+        """
+        Writes all pending redemptions to the database
+
+        Promotions with the same number of pending redemptions share one
+        UPDATE ... WHERE promotion_id IN (...) statement and the whole
+        flush runs in a single transaction. The UPDATE is the one of
+        Promotion.redemption(), so a promotion given caps since its
+        redemptions were buffered doesn't get counted past them: its
+        pending redemptions are dropped and logged instead. If the write
+        fails the counts are put back so the next flush can retry them.
+
+        Returns the number of redemptions written
+        """
+        with self._flush_lock:
+            self._epoch += 1
+            try:
+                return self._write(self._drain())
+            finally:
+                self._epoch += 1
+
+    def _write(self, totals):
+        """ Adds drained counts to the counters, the flush lock must be held """
+        if not totals:
+            return 0
+        batches = defaultdict(list)
+        for promotion_id, count in totals.items():
+            batches[count].append(promotion_id)
+        table = Promotion.__table__
+        now = int(time.time())
+        flushed = 0
+        try:
+            with db.engine.begin() as conn:
+                for count, promotion_ids in batches.items():
+                    updated = conn.execute(Promotion.redemption(
+                        table.c.promotion_id.in_(promotion_ids), count, now)).rowcount
+                    flushed += updated * count
+        except Exception as error:
+            self.logger.error('Redemption flush failed: %s', error)
+            self._restore(totals)
+            raise
+        for promotion_id in totals:
+            promotion_cache.invalidate(promotion_id)
+        dropped = sum(totals.values()) - flushed
+        if dropped:
+            self.logger.error('Dropped %s buffered redemptions of deleted promotions '
+                              'or past the caps of their promotions', dropped)
+        self.logger.info('Flushed %s redemptions for %s promotions',
+                         flushed, len(totals))
+        return flushed
@@ -0,0 +1,155 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Redemption Log module
+
+This module queues redemption events in memory and appends them to the
+redemption table in batches, so the events of many concurrent requests
+go out as a few multi-row INSERT statements instead of one per request.
+
+A background thread flushes the queue every flush_interval seconds, or
+sooner once it holds flush_threshold events, and a final flush runs when
+the process exits. Events queued since the last flush are lost if the
+process dies, like the redemptions of the RedemptionBuffer.
+
+A flush rejected for the data of some events is split in halves until
+the bad events are found, and they are dropped with an error so they
+can't block the others. Events of a flush that failed for another
+reason, like a lost database, are queued again, up to max_queued events
+after which the oldest are dropped.
+"""
+import logging
+import threading
+import time
+from sqlalchemy import exc
+from . import db
+from .models import Redemption
+from .flusher import BackgroundFlusher
+
+
+class RedemptionLog(BackgroundFlusher):
+    """ In-process queue of redemption events written by batched INSERTs """
+    logger = logging.getLogger(__name__)
+    thread_name = 'redemption-log-flush'
+
+    def __init__(self, flush_interval=1.0, flush_threshold=1000, batch_size=1000,
+                 max_queued=100000):
+        """
+        Args:
+            flush_interval (float): seconds between two flushes
+            flush_threshold (int): queued events that trigger a flush early
+            batch_size (int): the most rows of a single INSERT statement
+            max_queued (int): the most events kept queued after failed flushes
+        """
+        BackgroundFlusher.__init__(self, flush_interval)
+        self.flush_threshold = flush_threshold
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self._events = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, promotion_id, quantity=1, order_id=None, customer_id=None, redeemed_at=None):
+        """ Queues a redemption event, at the current time unless redeemed_at is given """
+        event = {'promotion_id': promotion_id,
+                 'quantity': quantity,
+                 'order_id': order_id,
+                 'customer_id': customer_id,
+                 'redeemed_at': int(time.time()) if redeemed_at is None else redeemed_at}
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= self.flush_threshold
+        self.start()
+        if full:
+            self.wakeup()
+
+    def __len__(self):
+        return len(self._events)
+
+    def clear(self):
+        """ Drops every queued event """
+        with self._lock:
+            self._events = []
+
+    def flush(self):
+        """
+        Appends all queued events to the redemption table
+
+        The events are written batch_size rows per INSERT statement in a
+        single transaction. Events rejected for their data are found and
+        dropped, and the others are written. If the write fails for another
+        reason they are queued again, in front of the newer ones, so the
+        next flush can retry them.
+
+        Returns the number of events written
+        """
+        with self._flush_lock:
+            with self._lock:
+                events = self._events
+                self._events = []
+            if not events:
+                return 0
+            try:
+                self._insert(events)
+            except (exc.IntegrityError, exc.DataError) as error:
+                self.logger.error('Redemption log flush rejected: %s', error)
+                written = self._insert_valid(events)
+                self.logger.info('Logged %s redemption events', written)
+                return written
+            except Exception as error:
+                self.logger.error('Redemption log flush failed: %s', error)
+                self._requeue(events)
+                raise
+            self.logger.info('Logged %s redemption events', len(events))
+            return len(events)
+
+    def _insert(self, events):
+        """ Inserts events in one transaction, batch_size rows per statement """
+        table = Redemption.__table__
+        with db.engine.begin() as conn:
+            for start in range(0, len(events), self.batch_size):
+                # values() of a list of rows is one multi-row INSERT,
+                # not an executemany of single-row ones
+                conn.execute(table.insert().values(events[start:start + self.batch_size]))
+
+    def _insert_valid(self, events):
+        """ Inserts the events the database accepts, in halves, and returns how many """
+        if len(events) == 1:
+            try:
+                self._insert(events)
+            except (exc.IntegrityError, exc.DataError) as error:
+                self.logger.error('Dropped redemption event %s: %s', events[0], error)
+                return 0
+            return 1
+        middle = len(events) // 2
+        written = 0
+        for half in (events[:middle], events[middle:]):
+            try:
+                self._insert(half)
+                written += len(half)
+            except (exc.IntegrityError, exc.DataError):
+                written += self._insert_valid(half)
+        return written
+
+    def _requeue(self, events):
+        """ Puts events back in front of the queue, dropping the oldest past max_queued """
+        with self._lock:
+            self._events = events + self._events
+            dropped = len(self._events) - self.max_queued
+            if dropped > 0:
+                self._events = self._events[dropped:]
+        if dropped > 0:
+            self.logger.error('Dropped the %s oldest redemption events, the queue is full',
+                              dropped)
@@ -19,19 +19,59 @@ Paths:
 ------
 GET /promotions - Returns a list all of the Promotions
 GET /promotions/{promotion_id} - Returns the Promotion with a given promotion_id number
+GET /promotions/export - Streams every Promotion as NDJSON or CSV
+GET /promotions/best/{product_id} - Returns the best Promotion of a product
+GET /promotions/best?product_id={id}&product_id={id} - Returns the best Promotion of many products
+GET /promotions/active/{product_id} - Returns the active Promotions of a product
 POST /promotions - creates a new Promotion record
+POST /promotions/bulk - creates many Promotion records at once
 PUT /promotions/{id} - updates a Promotion record
 DELETE /promotions/{id} - deletes a Promotion record
+PATCH /promotions - updates many Promotion records at once
+DELETE /promotions - deletes many Promotion records at once
 POST /promotions/{id}/redeem - redeem a Promotion record
+POST /promotions/redeem - redeem many Promotion records at once
+GET /promotions/redemptions - Returns the redemptions per Promotion per time bucket
+GET /metrics - Returns the request, database and cache metrics for Prometheus
 """
 
 import sys
+import calendar
+import numbers
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import json
+import time
+from datetime import datetime
+from flask import Flask, Response, request, url_for, make_response, abort, g
+from flask import stream_with_context
 from flask_api import status    # HTTP Status Codes
-from werkzeug.exceptions import NotFound
-from app.models import Promotion, DataValidationError
-from app import app
+from werkzeug.exceptions import NotFound, PreconditionFailed
+from app.models import Promotion, DataValidationError, promotion_cache, SEARCH_CRITERIA, FIELDS
+from app.models import OPEN_DATES, Redemption
+from app.validation import parse_datetime, format_datetime
+from app.redemption_buffer import RedemptionBuffer
+from app.redemption_log import RedemptionLog
+from app.idempotency import IdempotencyStore, idempotent
+from app.encoding import jsonify, dumps, etag, etag_base
+from app.pool import pool_metrics
+from app.metrics import request_metrics, gauges
+from app.profiler import SqlProfile, sampled
+from app import app, db
+
+# Holds redemptions in memory when REDEEM_BUFFER_ENABLED is set
+redemption_buffer = RedemptionBuffer(app.config['REDEEM_BUFFER_SHARDS'],
+                                     app.config['REDEEM_BUFFER_FLUSH_INTERVAL'],
+                                     app.config['REDEEM_BUFFER_FLUSH_THRESHOLD'])
+
+# Queues redemption events for the redemption table when REDEMPTION_LOG_ENABLED is set
+redemption_log = RedemptionLog(app.config['REDEMPTION_LOG_FLUSH_INTERVAL'],
+                               app.config['REDEMPTION_LOG_FLUSH_THRESHOLD'],
+                               app.config['REDEMPTION_LOG_BATCH_SIZE'],
+                               app.config['REDEMPTION_LOG_MAX_QUEUED'])
+
+# Responses to replay for retried POSTs with an Idempotency-Key
+idempotency_store = IdempotencyStore(app.config['IDEMPOTENCY_CACHE_SIZE'],
+                                     app.config['IDEMPOTENCY_TTL'])
 
 ######################################################################
 # Error Handlers
@@ -40,7 +80,11 @@ from app import app
 
 @app.errorhandler(DataValidationError)
 def request_validation_error(error):
-    """ Handles Value Errors from bad data """
+    """ Handles Value Errors from bad data, with the error of each field if known """
+    if error.errors:
+        app.logger.info(error.message)
+        return jsonify(status=400, error='Bad Request', message=error.message,
+                       errors=error.errors), 400
     return bad_request(error)
 
 
@@ -68,6 +112,30 @@ def method_not_supported(error):
     return jsonify(status=405, error='Method not Allowed', message=message), 405
 
 
+@app.errorhandler(409)
+def conflict(error):
+    """ Handles writes of changed resources with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=409, error='Conflict', message=message), 409
+
+
+@app.errorhandler(412)
+def precondition_failed(error):
+    """ Handles If-Match mismatches with 412_PRECONDITION_FAILED """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=412, error='Precondition Failed', message=message), 412
+
+
+@app.errorhandler(422)
+def unprocessable_entity(error):
+    """ Handles reused Idempotency-Keys with 422_UNPROCESSABLE_ENTITY """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=422, error='Unprocessable Entity', message=message), 422
+
+
 @app.errorhandler(415)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -83,6 +151,40 @@ def internal_server_error(error):
     app.logger.info(message)
     return jsonify(status=500, error='Internal Server Error', message=message), 500
 
+######################################################################
+# Request Metrics
+######################################################################
+@app.before_request
+def start_request_metrics():
+    """ Starts timing the request, and profiling its SQL if it is sampled """
+    g.request_started = time.time()
+    if app.config['SQL_PROFILE_ENABLED'] and sampled(app.config['SQL_PROFILE_SAMPLE_RATE']):
+        g.sql_profile = SqlProfile()
+
+
+@app.before_request
+def take_redemption_epoch():
+    """ Notes the redemption flush epoch before the request reads any counter """
+    g.redemption_epoch = redemption_buffer.epoch
+
+
+@app.after_request
+def record_request_metrics(response):
+    """ Records the status, latency and SQL queries of the request """
+    elapsed = observe_request(response.status_code)
+    profile = g.get('sql_profile')
+    if profile is not None and elapsed is not None:
+        response.headers['Server-Timing'] = profile.server_timing(elapsed)
+        log_sql_profile(profile, elapsed)
+    return response
+
+
+@app.teardown_request
+def record_failed_request_metrics(exception):
+    """ Records requests that failed before a response was made """
+    if exception is not None:
+        observe_request(status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 
 ######################################################################
 # GET INDEX
@@ -103,8 +205,10 @@ def list_promotions():
 
     Search the promotions in the database.
     <ul>
-    <li>Only the first non-empty field will be considered.</li>
+    <li>Every non-empty field must match, the _min and _max fields are inclusive ranges.</li>
     <li>An empty query will result in a list of all promotion entries in the database</li>
+    <li>Results are sorted by promotion_id unless sort is given, and paged. When more
+    results exist, the Link header holds the URL of the next page.</li>
     </ul>
     ---
     tags:
@@ -132,9 +236,87 @@ def list_promotions():
       maximum: 100.0
       minimum: 0
       format: int32
+    - name: discount_ratio_min
+      in: query
+      description: smallest discount ratio of the promotions
+      required: false
+      type: integer
+      format: int32
+    - name: discount_ratio_max
+      in: query
+      description: largest discount ratio of the promotions
+      required: false
+      type: integer
+      format: int32
+    - name: promotion_id_min
+      in: query
+      description: smallest promotion_id of the promotions
+      required: false
+      type: integer
+      format: int32
+    - name: promotion_id_max
+      in: query
+      description: largest promotion_id of the promotions
+      required: false
+      type: integer
+      format: int32
+    - name: active_at
+      in: query
+      description: only the promotions active at this ISO 8601 UTC datetime
+      required: false
+      type: string
+      format: date-time
+    - name: sort
+      in: query
+      description: field to sort by (promotion_id, name, product_id, discount_ratio,
+        counter, version, start_date, end_date, max_redemptions, rate_limit or
+        rate_period), prefixed by - for descending order
+      required: false
+      type: string
+    - name: limit
+      in: query
+      description: maximum number of promotions to return, capped by the server
+      required: false
+      type: integer
+      minimum: 1
+      format: int32
+    - name: after_id
+      in: query
+      description: promotion_id of the last promotion of the previous page (the next page cursor)
+      required: false
+      type: integer
+      minimum: 0
+      format: int32
+    - name: after_value
+      in: query
+      description: sort field value of the last promotion of the previous page, when sorting
+      required: false
+      type: string
+    - name: after_null
+      in: query
+      description: true instead of after_value when the last promotion of the previous page
+        has no value for the sort field
+      required: false
+      type: boolean
+    - name: fields
+      in: query
+      description: comma separated fields to return (promotion_id, name, product_id,
+        discount_ratio, counter, version, start_date, end_date, max_redemptions, rate_limit,
+        rate_period), all of them by default
+      required: false
+      type: string
     responses:
       200:
         description: search results matching criteria
+        headers:
+          Link:
+            type: string
+            description: URL of the next page, with rel="next", when there is one
+          ETag:
+            type: string
+            description: strong ETag of the page
+      304:
+        description: the page matches the If-None-Match ETag
         schema:
           type: array
           items:
@@ -142,22 +324,132 @@ def list_promotions():
       400:
         description: bad input parameter
     """
-    promotions = []
-    promotion_id = request.args.get('promotion_id')
-    name = request.args.get('name')
-    product_id = request.args.get('product_id')
-    discount_ratio = request.args.get('discount_ratio')
-    if name:
-        promotions = Promotion.find_by_name(name)
-    elif product_id:
-        promotions = Promotion.find_by_product_id(product_id)
-    elif discount_ratio:
-        promotions = Promotion.find_by_discount_ratio(discount_ratio)
+    criteria = {}
+    if request.args.get('name'):
+        criteria['name'] = request.args.get('name')
+    if request.args.get('active_at'):
+        criteria['active_at'] = get_datetime_arg('active_at', None)
+    for key in SEARCH_CRITERIA:
+        if key not in ('name', 'active_at'):
+            value = get_int_arg(key, None)
+            if value is not None:
+                criteria[key] = value
+    sort = request.args.get('sort') or 'promotion_id'
+    sort_field = sort.lstrip('-')
+    max_page_size = app.config['PROMOTIONS_MAX_PAGE_SIZE']
+    limit = min(get_int_arg('limit', max_page_size, minimum=1), max_page_size)
+    after_id = get_int_arg('after_id', None, minimum=0)
+    after_value = None
+    if after_id is not None and sort_field != 'promotion_id':
+        if request.args.get('after_null') == 'true':
+            # an open end is serialized as null but stored as a date
+            after_value = OPEN_DATES.get(sort_field)
+        elif 'after_value' not in request.args:
+            raise DataValidationError('Invalid query: after_value is needed to page by ' + sort)
+        elif sort_field in OPEN_DATES:
+            after_value = get_datetime_arg('after_value', OPEN_DATES[sort_field])
+        elif sort_field == 'name':
+            # a name can be empty, only after_null stands for a missing one
+            after_value = request.args.get('after_value')
+        else:
+            after_value = get_int_arg('after_value', None)
+    fields = get_fields_arg()
+    columns = None
+    if fields or fast_reads():
+        # paging needs the promotion_id and the sort field even if not returned
+        columns = list(fields or FIELDS)
+        for field in ('promotion_id', sort_field):
+            if field not in columns:
+                columns.append(field)
+    # one extra row tells us whether there is a next page
+    promotions = Promotion.search(criteria, sort, after_id, after_value, limit + 1, columns)
+
+    if columns:
+        results = add_pending_counters(Promotion.serialize_rows(promotions, columns))
     else:
-        promotions = Promotion.all()
+        results = serialize_promotions(promotions)
+    headers = {}
+    if len(results) > limit:
+        results = results[:limit]
+        args = request.args.to_dict()
+        args.update(after_id=results[-1]['promotion_id'], limit=limit)
+        if sort_field != 'promotion_id':
+            last_value = results[-1][sort_field]
+            args.pop('after_value' if last_value is None else 'after_null', None)
+            if last_value is None:
+                args['after_null'] = 'true'
+            else:
+                args['after_value'] = last_value
+        next_url = url_for('list_promotions', _external=True, **args)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    if fields:
+        results = [project(result, fields) for result in results]
+    return conditional(make_response(jsonify(results), status.HTTP_200_OK, headers))
+
+
+######################################################################
+# EXPORT ALL PROMOTIONS
+######################################################################
+EXPORT_FIELDS = list(FIELDS)
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
 
-    results = [promotion.serialize() for promotion in promotions]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+
+@app.route('/promotions/export', methods=['GET'])
+def export_promotions():
+    """
+    Exports all of the Promotions
+
+    Streams every promotion in promotion_id order as newline delimited
+    JSON (the default) or CSV. The response is sent in chunks while the
+    table is read, so it starts immediately and doesn't need to fit in memory.
+    ---
+    tags:
+    - promotions
+    produces:
+    - application/x-ndjson
+    - text/csv
+    parameters:
+    - name: format
+      in: query
+      description: ndjson or csv
+      required: false
+      type: string
+      enum: [ndjson, csv]
+    responses:
+      200:
+        description: every promotion, one per line
+      400:
+        description: unsupported format
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        raise DataValidationError('Invalid export format: expecting ndjson or csv')
+    batch_size = app.config['PROMOTIONS_EXPORT_BATCH_SIZE']
+    encode = json_line if export_format == 'ndjson' else csv_line
+
+    def generate():
+        """ Yields the export a batch of rows at a time """
+        pending = {}
+        if app.config['REDEEM_BUFFER_ENABLED']:
+            pending = redemption_buffer.pending_counts()
+        lines = []
+        if export_format == 'csv':
+            lines.append(csv_line(EXPORT_FIELDS))
+        if fast_reads():
+            results = Promotion.iter_rows(batch_size)
+        else:
+            results = (promotion.serialize() for promotion in Promotion.iter_all(batch_size))
+        for result in results:
+            result['counter'] += pending.get(result['promotion_id'], 0)
+            lines.append(encode(result))
+            if len(lines) >= batch_size:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    return Response(stream_with_context(generate()),
+                    mimetype=EXPORT_MIMETYPES[export_format])
 
 
 ######################################################################
@@ -180,20 +472,161 @@ def get_promotions(promotion_id):
       description: Numeric ID of the promotion to get
       required: true
       type: integer
+    - name: fields
+      in: query
+      description: comma separated fields to return, all of them by default
+      required: false
+      type: string
+    - name: If-None-Match
+      in: header
+      description: ETags of cached copies, answered with 304 if one is current
+      required: false
+      type: string
     responses:
       200:
         description: promotion retrieved
+        headers:
+          ETag:
+            type: string
+            description: strong ETag of the promotion
         schema:
           $ref: '#/definitions/ResponsePromotionObject'
+      304:
+        description: the promotion matches the If-None-Match ETag
       400:
         description: invalid input, object invalid
       404:
         description: promotion not found, object invalid
     """
-    promotion = Promotion.find(promotion_id)
-    if not promotion:
+    fields = get_fields_arg()
+    columns = fields + ['promotion_id'] if fields and 'promotion_id' not in fields else fields
+    result = Promotion.find_serialized(promotion_id, columns)
+    if not result:
         raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    result = add_pending_redemptions(result)
+    if fields:
+        result = project(result, fields)
+    return conditional(make_response(jsonify(result), status.HTTP_200_OK),
+                       etag(result, 'counter'))
+
+
+######################################################################
+# BEST PROMOTION OF A PRODUCT
+######################################################################
+
+
+@app.route('/promotions/best/<int:product_id>', methods=['GET'])
+def get_best_promotion(product_id):
+    """
+    Retrieves the best Promotion of a product
+
+    This endpoint will return the Promotion of a product with the highest
+    discount ratio, the lowest promotion_id winning a tie, among those whose
+    validity window contains the current time
+    ---
+    tags:
+    - promotions
+    parameters:
+    - name: product_id
+      in: path
+      description: Numeric ID of the product
+      required: true
+      type: integer
+    responses:
+      200:
+        description: promotion retrieved
+        schema:
+          $ref: '#/definitions/ResponsePromotionObject'
+      404:
+        description: the product has no promotion
+    """
+    result = Promotion.find_best_for_product(product_id)
+    if not result:
+        raise NotFound("Product with id '{}' has no promotion.".format(product_id))
+    return make_response(jsonify(add_pending_redemptions(result)), status.HTTP_200_OK)
+
+
+@app.route('/promotions/best', methods=['GET'])
+def list_best_promotions():
+    """
+    Retrieves the best Promotion of many products
+
+    This endpoint will return the best active Promotion of every product_id
+    given, for example all of the products in a cart, in one request
+    ---
+    tags:
+    - promotions
+    parameters:
+    - name: product_id
+      in: query
+      description: Numeric ID of a product, repeated for each product
+      required: true
+      type: array
+      items:
+        type: integer
+      collectionFormat: multi
+    responses:
+      200:
+        description: the best promotion of each product, null when it has none
+      400:
+        description: invalid input
+    """
+    try:
+        product_ids = [int(product_id) for product_id in request.args.getlist('product_id')]
+    except ValueError:
+        raise DataValidationError('Invalid query: product_id must be an integer')
+    if not product_ids:
+        raise DataValidationError('Invalid query: expecting at least one product_id')
+    best = Promotion.find_best_for_products(product_ids)
+    results = [{"product_id": product_id,
+                "promotion": add_pending_redemptions(best[product_id]) if best[product_id] else None}
+               for product_id in product_ids]
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+
+######################################################################
+# ACTIVE PROMOTIONS OF A PRODUCT
+######################################################################
+
+
+@app.route('/promotions/active/<int:product_id>', methods=['GET'])
+def list_active_promotions(product_id):
+    """
+    Returns the Promotions of a product that are active at a time
+
+    The promotions are found in the in-memory validity windows of the
+    product's promotions, without a database query once it is loaded.
+    ---
+    tags:
+    - promotions
+    produces:
+    - application/json
+    parameters:
+    - name: product_id
+      in: path
+      description: the product to find the active promotions of
+      required: true
+      type: integer
+    - name: at
+      in: query
+      description: ISO 8601 UTC datetime the promotions must be active at, now by default
+      required: false
+      type: string
+      format: date-time
+    responses:
+      200:
+        description: the active promotions, sorted by promotion_id
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/ResponsePromotionObject'
+      400:
+        description: invalid datetime
+    """
+    point = get_datetime_arg('at', None) or datetime.utcnow()
+    results = [add_pending_redemptions(result)
+               for result in Promotion.find_active_for_product(product_id, point)]
+    return make_response(jsonify(results), status.HTTP_200_OK)
 
 
 ######################################################################
@@ -202,11 +635,14 @@ def get_promotions(promotion_id):
 
 
 @app.route('/promotions', methods=['POST'])
+@idempotent(idempotency_store)
 def create_promotions():
     """
     Creates a Promotion
 
-    This endpoint will create a Promotion based the data in the body that is posted
+    This endpoint will create a Promotion based the data in the body that is posted.
+    A retry with the Idempotency-Key of an earlier request gets its response
+    again instead of creating another Promotion.
     ---
     tags:
     - promotions
@@ -221,6 +657,11 @@ def create_promotions():
       required: false
       schema:
         $ref: '#/definitions/PromotionObject'
+    - name: Idempotency-Key
+      in: header
+      description: unique key of the request, to retry it safely
+      required: false
+      type: string
     responses:
       201:
         description: item created
@@ -228,6 +669,10 @@ def create_promotions():
           $ref: '#/definitions/ResponsePromotionObject'
       400:
         description: invalid input, object invalid
+      409:
+        description: a request with the same Idempotency-Key is in progress
+      422:
+        description: the Idempotency-Key was used for another request
     """
     check_content_type('application/json')
     promotion = Promotion()
@@ -241,6 +686,70 @@ def create_promotions():
                          })
 
 
+######################################################################
+# ADD MANY PROMOTIONS
+######################################################################
+
+
+@app.route('/promotions/bulk', methods=['POST'])
+def bulk_create_promotions():
+    """
+    Creates many Promotions
+
+    This endpoint creates Promotions from a JSON array, or from newline
+    delimited JSON sent as application/x-ndjson. Every promotion is
+    validated and the valid ones are inserted in batches. The result
+    holds the new promotion_id or the error for each item, in order.
+    With atomic=true nothing is inserted unless every item is valid.
+    ---
+    tags:
+    - promotions
+    consumes:
+    - application/json
+    - application/x-ndjson
+    produces:
+    - application/json
+    parameters:
+    - in: body
+      name: Promotions
+      description: Promotion entries to add
+      required: true
+      schema:
+        type: array
+        items:
+          $ref: '#/definitions/PromotionObject'
+    - name: atomic
+      in: query
+      description: reject the whole batch if any promotion is invalid
+      required: false
+      type: boolean
+    - name: ids
+      in: query
+      description: set to false to skip reporting the new ids, for faster loads
+      required: false
+      type: boolean
+    responses:
+      201:
+        description: batch processed
+      400:
+        description: invalid input, or an invalid item with atomic=true
+    """
+    if request.headers.get('Content-Type') == 'application/x-ndjson':
+        payloads = read_ndjson(request.stream)
+    else:
+        check_content_type('application/json')
+        payloads = request.get_json()
+        if not isinstance(payloads, list):
+            raise DataValidationError('Invalid promotions: body of request must be a list')
+    atomic = request.args.get('atomic', 'false').lower() == 'true'
+    return_ids = request.args.get('ids', 'true').lower() != 'false'
+    results = Promotion.bulk_create(payloads, app.config['PROMOTIONS_BULK_CHUNK_SIZE'],
+                                    atomic, return_ids)
+    errors = len([result for result in results if 'error' in result])
+    message = {"created": len(results) - errors, "errors": errors, "results": results}
+    return make_response(jsonify(message), status.HTTP_201_CREATED)
+
+
 ######################################################################
 # UPDATE AN EXISTING PROMOTION
 ######################################################################
@@ -251,6 +760,8 @@ def update_promotions(promotion_id):
 
     It isn't necessary to fill in all three fields. Only the non-empty
     fields will be updated. The empty fields will be left as it is.
+    If the body holds the version that was read, the update is rejected
+    when the promotion has been changed since.
     ---
     tags:
     - promotions
@@ -266,24 +777,47 @@ def update_promotions(promotion_id):
       required: false
       schema:
         $ref: '#/definitions/Promotion'
+    - name: If-Match
+      in: header
+      description: only update the promotion if its current ETag is one of these
+      required: false
+      type: string
     responses:
       200:
         description: promotion retrieved
+        headers:
+          ETag:
+            type: string
+            description: strong ETag of the updated promotion
         schema:
           $ref: '#/definitions/ResponsePromotionObject'
       400:
         description: invalid input, object invalid
       404:
         description: promotion not found, object invalid
+      409:
+        description: the promotion was changed since the given version
+      412:
+        description: the promotion doesn't match the If-Match ETag
     """
     check_content_type('application/json')
+    data = request.get_json()
+    if isinstance(data, dict) and any(field in data for field in CAP_FIELDS):
+        # the buffered redemptions were accepted under the current caps
+        flush_pending_redemptions([promotion_id])
     promotion = Promotion.find(promotion_id)
     if not promotion:
         raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
-    promotion.deserialize_partial(request.get_json())
+    check_if_match(promotion.serialize())
+    if isinstance(data, dict) and 'version' in data:
+        promotion.check_version(data['version'])
+    promotion.deserialize_partial(data)
     promotion.id = promotion_id
     promotion.save()
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    result = serialize_promotion(promotion)
+    response = make_response(jsonify(result), status.HTTP_200_OK)
+    response.set_etag(etag(result, 'counter'))
+    return response
 
 
 ######################################################################
@@ -304,24 +838,135 @@ def delete_promotions(promotion_id):
       description: Numeric ID of the promotion to get
       required: true
       type: integer
+    - name: If-Match
+      in: header
+      description: only delete the promotion if its current ETag is one of these
+      required: false
+      type: string
     responses:
       204:
         description: promotion deleted
+      409:
+        description: the promotion was changed while it was being deleted
+      412:
+        description: the promotion doesn't match the If-Match ETag
     """
     promotion = Promotion.find(promotion_id)
+    check_if_match(promotion.serialize() if promotion else None)
     if promotion:
         promotion.delete()
+    redemption_buffer.discard(promotion_id)
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# UPDATE MANY PROMOTIONS
+######################################################################
+@app.route('/promotions', methods=['PATCH'])
+def bulk_update_promotions():
+    """
+    Updates many Promotions
+
+    Applies the same changes to the Promotions listed in promotion_ids,
+    or to every Promotion of a product_id. The promotions are updated in
+    chunks and the number of promotions changed is returned. A change of
+    only start_date or end_date skips the promotions whose validity window
+    it would leave empty, and their ids are returned as skipped.
+    ---
+    tags:
+    - promotions
+    consumes:
+    - application/json
+    produces:
+    - application/json
+    parameters:
+    - in: body
+      name: Update
+      description: the promotions to update and the changes to apply
+      required: true
+      schema:
+        type: object
+        required: [changes]
+        properties:
+          promotion_ids: {type: array, items: {type: integer}, example: [1, 2]}
+          product_id: {type: integer, example: 1785}
+          changes:
+            $ref: '#/definitions/Promotion'
+    responses:
+      200:
+        description: number of promotions updated and the ids of those skipped
+      400:
+        description: invalid input
+    """
+    check_content_type('application/json')
+    data = request.get_json()
+    promotion_ids, product_id = parse_bulk_filter(data)
+    changes = Promotion.validate(data.get('changes'), partial=True)
+    if any(field in changes for field in CAP_FIELDS):
+        # the buffered redemptions were accepted under the current caps
+        flush_pending_redemptions(promotion_ids or redemption_buffer.pending_counts())
+    affected, skipped = Promotion.bulk_update(changes, promotion_ids, product_id,
+                                              app.config['PROMOTIONS_BULK_CHUNK_SIZE'])
+    return make_response(jsonify(affected=affected, skipped=skipped), status.HTTP_200_OK)
+
+
+######################################################################
+# DELETE MANY PROMOTIONS
+######################################################################
+@app.route('/promotions', methods=['DELETE'])
+def bulk_delete_promotions():
+    """
+    Deletes many Promotions
+
+    Deletes the Promotions listed in promotion_ids, or every Promotion of
+    a product_id, in chunks and returns the number of promotions deleted.
+    ---
+    tags:
+    - promotions
+    consumes:
+    - application/json
+    produces:
+    - application/json
+    parameters:
+    - in: body
+      name: Filter
+      description: the promotions to delete
+      required: true
+      schema:
+        type: object
+        properties:
+          promotion_ids: {type: array, items: {type: integer}, example: [1, 2]}
+          product_id: {type: integer, example: 1785}
+    responses:
+      200:
+        description: number of promotions deleted
+      400:
+        description: invalid input
+    """
+    check_content_type('application/json')
+    promotion_ids, product_id = parse_bulk_filter(request.get_json())
+    affected, deleted_ids = Promotion.bulk_delete(promotion_ids, product_id,
+                                                  app.config['PROMOTIONS_BULK_CHUNK_SIZE'])
+    for promotion_id in deleted_ids:
+        redemption_buffer.discard(promotion_id)
+    return make_response(jsonify(affected=affected), status.HTTP_200_OK)
+
+
 ######################################################################
 # REDEEM A PROMOTION
 ######################################################################
 @app.route('/promotions/<int:promotion_id>/redeem', methods=['POST'])
+@idempotent(idempotency_store)
 def redeem_promotions(promotion_id):
     """
     Redeems a Promotion
 
-    This endpoint will increment the counter of a Promotion by 1.
+    This endpoint will increment the counter of a Promotion by 1, unless
+    that takes it past its max_redemptions or its rate_limit.
+    When REDEEM_BUFFER_ENABLED is set the increment of a Promotion without
+    caps is buffered in memory and written to the database by the next
+    batched flush. When REDEMPTION_LOG_ENABLED is set the redemption is
+    also appended to the redemption log. A retry with the Idempotency-Key
+    of an earlier request gets its response again without redeeming.
     ---
     tags:
     - promotions
@@ -331,6 +976,21 @@ def redeem_promotions(promotion_id):
       description: Numeric ID of the promotion to get
       required: true
       type: integer
+    - name: order_id
+      in: query
+      description: the order the promotion is redeemed for, kept in the redemption log
+      required: false
+      type: string
+    - name: customer_id
+      in: query
+      description: the customer redeeming the promotion, kept in the redemption log
+      required: false
+      type: string
+    - name: Idempotency-Key
+      in: header
+      description: unique key of the request, to retry it safely
+      required: false
+      type: string
     responses:
       200:
         description: promotion redeemed
@@ -338,12 +998,266 @@ def redeem_promotions(promotion_id):
           $ref: '#/definitions/ResponsePromotionObject'
       404:
         description: promotion not found, object invalid
+      409:
+        description: promotion has reached its max_redemptions or rate_limit, or a request
+          with the same Idempotency-Key is in progress
+      422:
+        description: the Idempotency-Key was used for another request
     """
-    promotion = Promotion.redeem_promotion(promotion_id)
+    order_id, customer_id = get_redemption_args()
+    if app.config['REDEEM_BUFFER_ENABLED']:
+        promotion = Promotion.find(promotion_id)
+        if not promotion:
+            raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
+        if promotion.max_redemptions is None and promotion.rate_limit is None:
+            # caps set since the promotion was read are checked by the flush
+            redemption_buffer.add(promotion_id)
+        else:
+            # caps are checked by the database against every redemption, so
+            # the buffered ones are counted first
+            flush_pending_redemptions([promotion_id])
+            promotion = Promotion.redeem_promotion(promotion_id)
+    else:
+        promotion = Promotion.redeem_promotion(promotion_id)
+    log_redemptions({promotion_id: 1}, order_id, customer_id)
     return make_response(
-        jsonify(promotion.serialize()),
+        jsonify(serialize_promotion(promotion)),
         status.HTTP_200_OK)
 
+######################################################################
+# REDEEM MANY PROMOTIONS
+######################################################################
+@app.route('/promotions/redeem', methods=['POST'])
+@idempotent(idempotency_store)
+def bulk_redeem_promotions():
+    """
+    Redeems many Promotions
+
+    This endpoint redeems every Promotion in a checkout basket at once.
+    The body is a list of promotion ids, or of objects with a promotion_id
+    and an optional quantity (default 1). All of the counters are updated
+    in a single transaction and the ids that don't exist are reported.
+    If any promotion would go past its max_redemptions or rate_limit
+    nothing is redeemed. When REDEMPTION_LOG_ENABLED is set an event per
+    redeemed promotion is appended to the redemption log. A retry with the
+    Idempotency-Key of an earlier request gets its response again without
+    redeeming.
+    ---
+    tags:
+    - promotions
+    consumes:
+    - application/json
+    produces:
+    - application/json
+    parameters:
+    - in: body
+      name: Redemptions
+      description: promotions to redeem
+      required: true
+      schema:
+        type: array
+        items:
+          type: object
+          properties:
+            promotion_id: {type: integer, example: 1}
+            quantity: {type: integer, example: 2}
+    - name: order_id
+      in: query
+      description: the order the promotions are redeemed for, kept in the redemption log
+      required: false
+      type: string
+    - name: customer_id
+      in: query
+      description: the customer redeeming the promotions, kept in the redemption log
+      required: false
+      type: string
+    - name: Idempotency-Key
+      in: header
+      description: unique key of the request, to retry it safely
+      required: false
+      type: string
+    responses:
+      200:
+        description: promotions redeemed, with their new counters and the missing ids
+      400:
+        description: invalid input
+      409:
+        description: a promotion has reached its max_redemptions or rate_limit, or a request
+          with the same Idempotency-Key is in progress
+      422:
+        description: the Idempotency-Key was used for another request
+    """
+    check_content_type('application/json')
+    quantities = parse_redemptions(request.get_json())
+    order_id, customer_id = get_redemption_args()
+    if app.config['REDEEM_BUFFER_ENABLED']:
+        found = Promotion.find_counters(quantities)
+        capped = [promotion_id for promotion_id in found if found[promotion_id][1]]
+        counters = {}
+        if capped:
+            # caps are checked by the database against every redemption, so
+            # the buffered ones are counted first
+            flush_pending_redemptions(capped)
+            counters = Promotion.redeem_promotions(
+                dict((promotion_id, quantities[promotion_id]) for promotion_id in capped))
+        buffered = dict((promotion_id, found[promotion_id][0]) for promotion_id in found
+                        if not found[promotion_id][1])
+        for promotion_id in buffered:
+            redemption_buffer.add(promotion_id, quantities[promotion_id])
+        if buffered:
+            counters.update(redemption_buffer.add_pending(buffered, g.redemption_epoch))
+    else:
+        counters = Promotion.redeem_promotions(quantities)
+    log_redemptions(dict((promotion_id, quantities[promotion_id]) for promotion_id in counters),
+                    order_id, customer_id)
+    redeemed = [{"promotion_id": promotion_id, "counter": counters[promotion_id]}
+                for promotion_id in sorted(counters)]
+    missing = sorted(promotion_id for promotion_id in quantities
+                     if promotion_id not in counters)
+    return make_response(jsonify(redeemed=redeemed, missing=missing), status.HTTP_200_OK)
+
+######################################################################
+# REDEMPTIONS PER TIME BUCKET
+######################################################################
+@app.route('/promotions/redemptions', methods=['GET'])
+def list_redemptions():
+    """
+    Retrieves the redemptions per Promotion per time bucket
+
+    This endpoint will return the number of redemptions of every Promotion
+    in each time bucket of a range, counted from the redemption log.
+    Buckets without redemptions are left out. Events reach the log within
+    REDEMPTION_LOG_FLUSH_INTERVAL seconds of their redemption.
+    ---
+    tags:
+    - promotions
+    parameters:
+    - name: since
+      in: query
+      description: start of the range, an ISO 8601 UTC datetime (a day before until by default)
+      required: false
+      type: string
+      format: date-time
+    - name: until
+      in: query
+      description: end of the range (excluded), an ISO 8601 UTC datetime (now by default)
+      required: false
+      type: string
+      format: date-time
+    - name: bucket
+      in: query
+      description: length of the buckets in seconds, which start at its multiples (3600 by default)
+      required: false
+      type: integer
+      minimum: 1
+    - name: promotion_id
+      in: query
+      description: Numeric ID of a promotion, repeated for each promotion (all by default)
+      required: false
+      type: array
+      items:
+        type: integer
+      collectionFormat: multi
+    responses:
+      200:
+        description: the redemptions of each promotion in each bucket, by promotion_id and time
+      400:
+        description: invalid input
+    """
+    until = get_datetime_arg('until', None)
+    # by default up to now, including the redemptions of the current second
+    until = int(time.time()) + 1 if until is None else calendar.timegm(until.timetuple())
+    since = get_datetime_arg('since', None)
+    since = until - 86400 if since is None else calendar.timegm(since.timetuple())
+    if since >= until:
+        raise DataValidationError('Invalid query: since must be before until')
+    bucket = get_int_arg('bucket', 3600, minimum=1)
+    try:
+        promotion_ids = [int(promotion_id)
+                         for promotion_id in request.args.getlist('promotion_id')]
+    except ValueError:
+        raise DataValidationError('Invalid query: promotion_id must be an integer')
+    results = [{"promotion_id": promotion_id,
+                "bucket_start": format_datetime(datetime.utcfromtimestamp(bucket_start)),
+                "redemptions": redemptions}
+               for promotion_id, bucket_start, redemptions in
+               Redemption.aggregate(since, until, bucket, promotion_ids)]
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+######################################################################
+# PROMOTION CACHE STATISTICS
+######################################################################
+@app.route('/promotions/cache', methods=['GET'])
+def promotion_cache_stats():
+    """
+    Returns the Promotion cache statistics
+
+    Reports the size and hit, miss, eviction and expiration counters of
+    the cache behind GET /promotions/{promotion_id}.
+    ---
+    tags:
+    - promotions
+    produces:
+    - application/json
+    responses:
+      200:
+        description: cache statistics
+    """
+    return make_response(jsonify(promotion_cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/promotions/pool', methods=['GET'])
+def connection_pool_stats():
+    """
+    Returns the database connection pool statistics
+
+    Reports how many checkouts there were, how long they waited for a
+    connection in total and at most, how many timed out, how many stale
+    connections were replaced, and the pool size, overflow and in use
+    and idle connections right now.
+    ---
+    tags:
+    - promotions
+    produces:
+    - application/json
+    responses:
+      200:
+        description: connection pool statistics
+    """
+    return make_response(jsonify(pool_metrics.stats(db.engine.pool)), status.HTTP_200_OK)
+
+######################################################################
+# METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Returns the service metrics in the Prometheus text format
+
+    Reports request counts by endpoint, method and status, latency
+    histograms by endpoint and method, the SQL queries and SQL time of
+    each endpoint, and the Promotion cache, Idempotency-Key store and
+    connection pool statistics.
+    ---
+    tags:
+    - promotions
+    produces:
+    - text/plain
+    responses:
+      200:
+        description: metrics in the Prometheus text format
+    """
+    lines = request_metrics.render()
+    lines += gauges('promotions_cache', promotion_cache.stats(), 'Promotion cache')
+    lines += gauges('promotions_idempotency', idempotency_store.stats(),
+                    'Idempotency-Key response store')
+    lines += gauges('promotions_db_pool', pool_metrics.stats(db.engine.pool),
+                    'Database connection pool')
+    return Response('\n'.join(lines) + '\n', status=status.HTTP_200_OK,
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 ######################################################################
 # Reset the Database
 ######################################################################
@@ -352,6 +1266,9 @@ def reset():
     """
     Reset the Database for test purposes
     """
+    redemption_buffer.clear()
+    redemption_log.clear()
+    idempotency_store.clear()
     Promotion.remove_all()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
@@ -363,13 +1280,247 @@ def reset():
 def init_db():
     """ Initialies the SQLAlchemy app """
     Promotion.init_db()
+    Promotion.rebuild_best_index()
+
+
+def observe_request(status_code):
+    """ Records the request in the metrics once, however it ended """
+    started = g.pop('request_started', None)
+    if started is None:
+        return None
+    elapsed = time.time() - started
+    request_metrics.observe(request.endpoint or 'unmatched', request.method, status_code,
+                            elapsed, g.get('db_queries', 0), g.get('db_query_seconds', 0.0))
+    return elapsed
+
+
+def log_sql_profile(profile, elapsed):
+    """ Logs the statements of a profiled request that is slow or runs too many """
+    problems = profile.problems(elapsed, app.config['SQL_PROFILE_SLOW_MS'],
+                                app.config['SQL_PROFILE_MAX_QUERIES'],
+                                app.config['SQL_PROFILE_REPEATED_QUERIES'])
+    if problems:
+        app.logger.warning('\n'.join(['{} {}: {}'.format(request.method, request.path,
+                                                         '; '.join(problems))] +
+                                      profile.report()))
+
+
+def get_redemption_args():
+    """ Returns the (order_id, customer_id) query parameters of a redeem """
+    values = []
+    for name in ('order_id', 'customer_id'):
+        value = request.args.get(name) or None
+        if value is not None and len(value) > Redemption.__table__.c[name].type.length:
+            raise DataValidationError('Invalid query: {} must be at most {} characters'.format(
+                name, Redemption.__table__.c[name].type.length))
+        values.append(value)
+    return tuple(values)
+
+
+def log_redemptions(quantities, order_id=None, customer_id=None):
+    """ Queues an event per redeemed promotion when REDEMPTION_LOG_ENABLED is set """
+    if app.config['REDEMPTION_LOG_ENABLED']:
+        for promotion_id, quantity in quantities.items():
+            redemption_log.add(promotion_id, quantity, order_id, customer_id)
+
+
+# The fields that limit the redemptions of a Promotion
+CAP_FIELDS = ('max_redemptions', 'rate_limit', 'rate_period')
+
+
+def flush_pending_redemptions(promotion_ids):
+    """ Writes the buffered redemptions if any of the promotions has some """
+    if any(redemption_buffer.pending(promotion_id) for promotion_id in promotion_ids):
+        redemption_buffer.flush()
+
+
+def add_pending_redemptions(result):
+    """ Returns a serialized Promotion with any buffered redemptions added to its counter """
+    if app.config['REDEEM_BUFFER_ENABLED'] and 'counter' in result:
+        promotion_id = result['promotion_id']
+        counters = redemption_buffer.add_pending({promotion_id: result['counter']},
+                                                 g.redemption_epoch)
+        if promotion_id in counters:
+            result = dict(result, counter=counters[promotion_id])
+    return result
+
+
+def serialize_promotion(promotion):
+    """ Serializes a Promotion, adding any buffered redemptions to its counter """
+    return add_pending_redemptions(promotion.serialize())
+
+
+def serialize_promotions(promotions):
+    """ Serializes Promotions, adding any buffered redemptions to their counters """
+    return add_pending_counters([promotion.serialize() for promotion in promotions])
+
+
+def add_pending_counters(results):
+    """ Adds any buffered redemptions to the counters of serialized Promotions """
+    if app.config['REDEEM_BUFFER_ENABLED'] and results and 'counter' in results[0]:
+        counters = redemption_buffer.add_pending(
+            dict((result['promotion_id'], result['counter']) for result in results),
+            g.redemption_epoch)
+        for result in results:
+            result['counter'] = counters.get(result['promotion_id'], result['counter'])
+    return results
+
+
+def conditional(response, response_etag=None):
+    """ Adds a strong ETag to a response and answers If-None-Match with 304 """
+    if response_etag is None:
+        response.add_etag()
+    else:
+        response.set_etag(response_etag)
+    return response.make_conditional(request)
+
+
+def check_if_match(result):
+    """
+    Raises PreconditionFailed unless a serialized Promotion matches the If-Match header
+
+    The counter is left out of the comparison, so redemptions made since
+    the client read the Promotion don't fail its edits. The Promotion is
+    the one being written, so the versioned UPDATE or DELETE that follows
+    fails if it changes after this check.
+    """
+    if not request.if_match:
+        return
+    if result is None:
+        raise PreconditionFailed('Promotion does not match If-Match.')
+    current = etag_base(etag(result, 'counter'))
+    if not request.if_match.star_tag and \
+       not any(etag_base(tag) == current for tag in request.if_match.as_set()):
+        raise PreconditionFailed('Promotion does not match If-Match.')
+
+
+def fast_reads():
+    """ Checks if the current endpoint reads rows without building Promotions """
+    return request.endpoint in app.config['PROMOTIONS_FAST_READ_ENDPOINTS']
+
+
+def project(result, fields):
+    """ Returns only the given fields of a serialized Promotion """
+    return dict((field, result[field]) for field in fields)
+
+
+def get_fields_arg():
+    """ Returns the fields query parameter as a list or None for every field """
+    value = request.args.get('fields')
+    if not value:
+        return None
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field not in FIELDS:
+            raise DataValidationError('Invalid query: unknown field ' + field)
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def get_int_arg(name, default, minimum=None):
+    """ Returns an integer query parameter or raises DataValidationError """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise DataValidationError('Invalid query: {} must be an integer'.format(name))
+    if minimum is not None and value < minimum:
+        raise DataValidationError('Invalid query: {} must be at least {}'.format(name, minimum))
+    return value
+
+
+def get_datetime_arg(name, default):
+    """ Returns an ISO 8601 datetime query parameter or raises DataValidationError """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    result = parse_datetime(value)
+    if result is None:
+        raise DataValidationError('Invalid query: {} must be an ISO 8601 datetime'.format(name))
+    return result
+
+
+def parse_bulk_filter(data):
+    """ Returns the (promotion_ids, product_id) filter of a bulk update or delete """
+    if not isinstance(data, dict):
+        raise DataValidationError('Invalid request: body of request contained bad or no data')
+    promotion_ids = data.get('promotion_ids')
+    product_id = data.get('product_id')
+    if (promotion_ids is None) == (product_id is None):
+        raise DataValidationError('Invalid request: expecting either promotion_ids or product_id')
+    if promotion_ids is not None:
+        if not isinstance(promotion_ids, list) or \
+           not all(is_int(promotion_id) for promotion_id in promotion_ids):
+            raise DataValidationError('Invalid request: promotion_ids must be a list of integers')
+    elif not is_int(product_id):
+        raise DataValidationError('Invalid request: product_id must be an integer')
+    return promotion_ids, product_id
+
+
+def parse_redemptions(data):
+    """ Returns the redemption quantities by promotion_id from a bulk redeem body """
+    if not isinstance(data, list) or not data:
+        raise DataValidationError('Invalid redemptions: body of request must be a non-empty list')
+    quantities = {}
+    for item in data:
+        if isinstance(item, dict):
+            promotion_id = item.get('promotion_id')
+            quantity = item.get('quantity', 1)
+        else:
+            promotion_id, quantity = item, 1
+        if not is_int(promotion_id) or not is_int(quantity) or quantity < 1:
+            raise DataValidationError('Invalid redemption: expecting an integer promotion_id '
+                                      'and a positive integer quantity')
+        quantities[promotion_id] = quantities.get(promotion_id, 0) + quantity
+    return quantities
+
+
+def is_int(value):
+    """ Checks for an integer that isn't a boolean """
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def read_ndjson(stream):
+    """ Parses newline delimited JSON, keeping unreadable lines as None """
+    payloads = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            payloads.append(json.loads(line))
+        except ValueError:
+            payloads.append(None)
+    return payloads
+
+
+def json_line(result):
+    """ Encodes a serialized Promotion as one line of NDJSON """
+    return dumps(result) + '\n'
+
+
+def csv_line(values):
+    """ Encodes a serialized Promotion (or the header names) as one CSV line """
+    if isinstance(values, dict):
+        values = [values[field] for field in EXPORT_FIELDS]
+    fields = []
+    for value in values:
+        value = u'' if value is None else u'{}'.format(value)
+        if any(char in value for char in u',"\r\n'):
+            value = u'"{}"'.format(value.replace(u'"', u'""'))
+        fields.append(value)
+    return u','.join(fields) + u'\r\n'
 
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
-    if request.headers['Content-Type'] == content_type:
+    if request.headers.get('Content-Type') == content_type:
         return
-    app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
+    app.logger.error('Invalid Content-Type: %s', request.headers.get('Content-Type'))
     abort(415, 'Content-Type must be {}'.format(content_type))
 
 
@@ -0,0 +1,164 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Validation module
+
+A Schema checks the fields of a payload against their Field definitions.
+Each Field is compiled once into a check function that only does the
+type, range and length tests it needs, so validating a payload is a
+loop over a few closures with no exceptions raised on the error path.
+Every field is checked and all of the errors are reported together.
+
+Datetimes are ISO 8601 strings in UTC, 2018-07-04 or 2018-07-04T09:30:00
+with optional fractions of a second, which are dropped, and an optional Z.
+"""
+import numbers
+import re
+from datetime import datetime
+
+# Largest value of a MySQL INT column
+INT_MAX = 2 ** 31 - 1
+
+# Exact types checked before the slower isinstance tests of the ABCs
+INTEGER_TYPES = (int, long)
+
+# Years before 1000 aren't stored by MySQL DATETIME columns
+DATETIME_PATTERN = re.compile(r'^([1-9]\d{3})-(\d{2})-(\d{2})'
+                              r'(?:T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?)?Z?\Z')
+
+
+def parse_datetime(value):
+    """ Returns the datetime of an ISO 8601 string, or None if it isn't one """
+    match = DATETIME_PATTERN.match(value)
+    if match is None:
+        return None
+    try:
+        return datetime(*[int(part) for part in match.groups() if part is not None])
+    except ValueError:
+        return None
+
+
+def format_datetime(value):
+    """ Returns a datetime as an ISO 8601 string, without fractions of a second """
+    return value.replace(microsecond=0).isoformat()
+
+
+class Field(object):
+    """
+    A field of a payload: a string, an integer that isn't a boolean, or
+    a datetime, where integers and datetimes can be null when nullable is set
+    """
+
+    def __init__(self, name, kind, required=True, minimum=None, maximum=None,
+                 max_length=None, nullable=False):
+        if kind not in ('string', 'integer', 'datetime'):
+            raise ValueError('Unknown field kind ' + kind)
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_length = max_length
+        self.nullable = nullable
+
+    def converter(self):
+        """ Returns the function that converts a valid value, or None to keep it """
+        if self.kind == 'datetime':
+            return lambda value: None if value is None else parse_datetime(value)
+        return None
+
+    def compile(self):
+        """ Returns a function of a value that returns an error message or None """
+        if self.kind == 'datetime':
+            nullable = self.nullable
+
+            def check_datetime(value):
+                if value is None and nullable:
+                    return None
+                if not isinstance(value, basestring) or parse_datetime(value) is None:
+                    return 'must be an ISO 8601 datetime'
+                return None
+            return check_datetime
+
+        if self.kind == 'string':
+            max_length = self.max_length
+            if max_length is None:
+                return lambda value: None if isinstance(value, basestring) else 'must be a string'
+
+            def check_string(value):
+                if not isinstance(value, basestring):
+                    return 'must be a string'
+                if len(value) > max_length:
+                    return 'must be at most {} characters'.format(max_length)
+                return None
+            return check_string
+
+        minimum, maximum, nullable = self.minimum, self.maximum, self.nullable
+        if minimum is not None and maximum is not None:
+            out_of_range = 'must be between {} and {}'.format(minimum, maximum)
+        elif minimum is not None:
+            out_of_range = 'must be at least {}'.format(minimum)
+        else:
+            out_of_range = 'must be at most {}'.format(maximum)
+
+        def check_integer(value):
+            if value is None and nullable:
+                return None
+            if type(value) not in INTEGER_TYPES and \
+               (not isinstance(value, numbers.Integral) or isinstance(value, bool)):
+                return 'must be an integer'
+            if (minimum is not None and value < minimum) or \
+               (maximum is not None and value > maximum):
+                return out_of_range
+            return None
+        return check_integer
+
+
+class Schema(object):
+    """ The fields of a payload, compiled once into their checks """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._checks = tuple((field.name, field.required, field.compile(), field.converter())
+                             for field in self.fields)
+
+    def validate(self, data, partial=False):
+        """
+        Checks every field of a dictionary
+
+        Fields that are not in the schema are ignored, and missing fields
+        are only errors when they are required and partial isn't set.
+
+        Returns (values, errors): the valid values and the error messages
+        by field name
+        """
+        values = {}
+        errors = {}
+        for name, required, check, convert in self._checks:
+            if name in data:
+                value = data[name]
+                error = check(value)
+                if error is None:
+                    values[name] = value if convert is None else convert(value)
+                else:
+                    errors[name] = error
+            elif required and not partial:
+                errors[name] = 'is required'
+        return values, errors
+
+
+def describe(errors):
+    """ Returns the errors of a payload as one message, ordered by field name """
+    return '; '.join('{} {}'.format(name, errors[name]) for name in sorted(errors))
@@ -54,3 +54,25 @@ def get_database_uri():
     logging.info("Conecting to database on host %s port %s", hostname, port)
     connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
     return connect_string.format(username, password, hostname, port, name)
+
+
+def get_pool_setting(name, default):
+    """
+    Returns a database connection pool setting as a string
+
+    The setting is read from the SQLALCHEMY_<NAME> environment variable,
+    then from the credentials of a user-provided service called
+    'promotions-db-pool' in VCAP_SERVICES, for example:
+      cf cups promotions-db-pool -p '{"pool_size": "10", "max_overflow": "5"}'
+    """
+    value = os.getenv('SQLALCHEMY_' + name.upper())
+    if value is not None:
+        return value
+    if 'VCAP_SERVICES' in os.environ:
+        services = json.loads(os.environ['VCAP_SERVICES'])
+        for service in services.get('user-provided', []):
+            if service.get('name') == 'promotions-db-pool':
+                credentials = service.get('credentials', {})
+                if name in credentials:
+                    return str(credentials[name])
+    return default
@@ -0,0 +1,29 @@
+"""
+Performance benchmarks for the Promotion service
+
+Run a benchmark from the project root with:
+  python -m benchmarks.<name>
+"""
+import os
+from app import app
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SQLITE_URI = 'sqlite:///' + os.path.join(BASEDIR, 'db/benchmark.db')
+
+
+def configure_database(default_uri=None):
+    """
+    Points the app at DATABASE_URI, or default_uri when it isn't set
+
+    SQLite doesn't use a queue pool, so the pool settings from config
+    are cleared for it.
+    """
+    uri = os.getenv('DATABASE_URI', default_uri)
+    if uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config['SQLALCHEMY_POOL_SIZE'] = None
+        app.config['SQLALCHEMY_POOL_TIMEOUT'] = None
+        app.config['SQLALCHEMY_POOL_RECYCLE'] = None
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = None
+    return app.config['SQLALCHEMY_DATABASE_URI']
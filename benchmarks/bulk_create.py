@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""
+Bulk Create Benchmark
+
+Sends 100,000 promotions (by default) to POST /promotions/bulk and
+measures how long they take to load, first with one multi-row INSERT per
+chunk and then with the rows inserted one by one, the way the database
+hands out the ids when a multi-row INSERT can't be trusted to (see
+Promotion.id_step). Every run checks that the reported ids point at the
+promotions that were sent, and the multi-row run fails if it takes more
+than TARGET_SECONDS.
+
+Run it from the project root with:
+  python -m benchmarks.bulk_create [promotions] [chunk_size]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - promotions : Integer the number of promotions to create (default 100000)
+    - chunk_size : Integer the rows per INSERT and commit (default 1000)
+"""
+from __future__ import print_function
+
+import json
+import sys
+import time
+from mock import patch
+from app import app, db
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+
+TARGET_SECONDS = 10.0
+
+
+def payloads(count):
+    """ Returns count promotions to create """
+    return [{'name': 'BULK{}'.format(number), 'product_id': number % 1000,
+             'discount_ratio': number % 100}
+            for number in range(count)]
+
+
+def run(count, batched):
+    """ Loads count promotions into an empty table and returns (seconds, ids correct) """
+    db.drop_all()
+    db.create_all()
+    body = json.dumps(payloads(count))
+    client = app.test_client()
+    with patch.object(Promotion, 'id_step', wraps=Promotion.id_step,
+                      **({} if batched else {'return_value': None})):
+        start = time.time()
+        resp = client.post('/promotions/bulk', data=body, content_type='application/json')
+        elapsed = time.time() - start
+    db.session.remove()
+    results = json.loads(resp.data)['results']
+    names = dict(db.session.query(Promotion.promotion_id, Promotion.name))
+    correct = resp.status_code == 201 and len(names) == count and \
+        all(names.get(result['promotion_id']) == 'BULK{}'.format(result['index'])
+            for result in results)
+    return elapsed, correct
+
+
+def main(count, chunk_size):
+    """ Runs the benchmark and returns the process exit code """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    app.config['PROMOTIONS_BULK_CHUNK_SIZE'] = chunk_size
+    print('Promotions: {}, chunk size: {}'.format(count, chunk_size))
+    failed = False
+    for batched in (True, False):
+        elapsed, correct = run(count, batched)
+        print('{:<24} {:8.2f} s {:10.0f} promotions/sec  ids {}'.format(
+            'multi-row INSERT' if batched else 'one INSERT per row', elapsed,
+            count / elapsed, 'correct' if correct else 'WRONG'))
+        failed = failed or not correct
+        if batched and elapsed > TARGET_SECONDS:
+            print('FAILED: expected {} promotions in under {:.0f} seconds'
+                  .format(count, TARGET_SECONDS))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    CHUNK_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    sys.exit(main(COUNT, CHUNK_SIZE))
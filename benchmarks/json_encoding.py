@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+JSON Encoding Benchmark
+
+Times building a GET /promotions list response of 1,000, 10,000 and
+100,000 promotions with flask.jsonify (pretty printed, as it was before),
+with the compact standard library encoder and with ujson when installed.
+
+Run it from the project root with:
+  python -m benchmarks.json_encoding [repeats]
+
+Arguments:
+----------
+    - repeats : Integer the number of timed runs of each encoder (default 5)
+"""
+from __future__ import print_function
+
+import sys
+import time
+import flask
+from mock import patch
+from app import app, encoding
+
+SIZES = (1000, 10000, 100000)
+
+
+def promotions(count):
+    """ Returns count serialized promotions """
+    return [{"promotion_id": number, "name": "PROMO{}".format(number),
+             "product_id": number % 1000, "discount_ratio": number % 100, "counter": number}
+            for number in range(1, count + 1)]
+
+
+def encoders():
+    """ Returns the timed encoders as (label, response builder) pairs """
+    def configured(name):
+        def respond(data):
+            with patch.dict(app.config, {'JSON_ENCODER': name,
+                                         'JSONIFY_PRETTYPRINT_REGULAR': False}):
+                return encoding.jsonify(data)
+        return respond
+
+    def flask_jsonify(data):
+        with patch.dict(app.config, {'JSONIFY_PRETTYPRINT_REGULAR': True}):
+            return flask.jsonify(data)
+
+    results = [('flask.jsonify (pretty)', flask_jsonify), ('json (compact)', configured('json'))]
+    if 'ujson' in encoding.ENCODERS:
+        results.append(('ujson', configured('ujson')))
+    return results
+
+
+def median_ms(respond, data, repeats):
+    """ Returns the median time to build a response in milliseconds """
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        respond(data)
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(repeats):
+    """ Times every encoder on every list size """
+    print('{:<26}'.format('Encoder (median ms)') +
+          ''.join('{:>12}'.format(size) for size in SIZES))
+    data = dict((size, promotions(size)) for size in SIZES)
+    with app.test_request_context():
+        for label, respond in encoders():
+            print('{:<26}'.format(label) +
+                  ''.join('{:>12.2f}'.format(median_ms(respond, data[size], repeats))
+                          for size in SIZES))
+
+
+if __name__ == '__main__':
+    REPEATS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    main(REPEATS)
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+"""
+Query Filter Benchmark
+
+Seeds the promotion table (1,000,000 rows by default) and compares
+multi-field searches composed in SQL by Promotion.search against the old
+pattern of fetching on the first non-empty field and filtering the rows
+in Python.
+
+Run it from the project root with:
+  python -m benchmarks.query_filters [rows] [repeats]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - rows : Integer the number of promotions to seed (default 1000000)
+    - repeats : Integer the number of timed runs of each query (default 20)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from app import db
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+from benchmarks.query_indexes import seed
+
+
+def client_side(name=None, product_id=None, discount_ratio_min=None, discount_ratio_max=None):
+    """ The old pattern: query one field, then filter and sort the rows locally """
+    if name:
+        rows = Promotion.find_by_name(name).all()
+    elif product_id:
+        rows = Promotion.find_by_product_id(product_id).all()
+    else:
+        rows = Promotion.all()
+    return sorted([row for row in rows
+                   if (name is None or row.name == name) and
+                   (product_id is None or row.product_id == product_id) and
+                   (discount_ratio_min is None or row.discount_ratio >= discount_ratio_min) and
+                   (discount_ratio_max is None or row.discount_ratio <= discount_ratio_max)],
+                  key=lambda row: -row.discount_ratio)[:100]
+
+
+def queries():
+    """ Returns the timed queries as (label, sql callable, client side callable) """
+    return [
+        ('product_id + discount range',
+         lambda: Promotion.search({'product_id': 4242, 'discount_ratio_min': 50},
+                                  '-discount_ratio', limit=100).all(),
+         lambda: client_side(product_id=4242, discount_ratio_min=50)),
+        ('name + product_id',
+         lambda: Promotion.search({'name': 'PROMO123', 'product_id': 4242},
+                                  '-discount_ratio', limit=100).all(),
+         lambda: client_side(name='PROMO123', product_id=4242)),
+        ('discount range, top 100',
+         lambda: Promotion.search({'discount_ratio_min': 90, 'discount_ratio_max': 95},
+                                  '-discount_ratio', limit=100).all(),
+         lambda: client_side(discount_ratio_min=90, discount_ratio_max=95)),
+    ]
+
+
+def median_ms(query, repeats):
+    """ Returns the median latency of a query in milliseconds """
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        query()
+        timings.append((time.time() - start) * 1000)
+        db.session.remove()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(rows, repeats):
+    """ Seeds the table and compares SQL composed and client side filtering """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    db.drop_all()
+    db.create_all()
+    start = time.time()
+    seed(rows)
+    print('Seeded {} promotions in {:.1f}s'.format(rows, time.time() - start))
+
+    print('{:<32}{:>14}{:>14}'.format('Query (median ms)', 'SQL search', 'Client side'))
+    for label, sql, client in queries():
+        # the client side scan of the whole table is slow, so time it less
+        print('{:<32}{:>14.3f}{:>14.3f}'.format(label, median_ms(sql, repeats),
+                                                median_ms(client, max(1, repeats // 10))))
+
+
+if __name__ == '__main__':
+    ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(ROWS, REPEATS)
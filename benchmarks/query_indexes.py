@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""
+Query Index Benchmark
+
+Seeds the promotion table (1,000,000 rows by default) and measures the
+latency of the name, product_id, discount_ratio and combined
+product_id/discount_ratio lookups behind GET /promotions, first without
+the secondary indexes and then with them.
+
+Run it from the project root with:
+  python -m benchmarks.query_indexes [rows] [repeats]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - rows : Integer the number of promotions to seed (default 1000000)
+    - repeats : Integer the number of timed runs of each query (default 20)
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+from app import db
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+
+SEED_CHUNK = 10000
+PRODUCTS = 100000
+
+
+def seed(rows):
+    """ Bulk inserts rows promotions with a fixed random seed """
+    rand = random.Random(42)
+    table = Promotion.__table__
+    with db.engine.begin() as conn:
+        for start in range(0, rows, SEED_CHUNK):
+            conn.execute(table.insert(), [
+                {"name": "PROMO{}".format(number % 50000),
+                 "product_id": rand.randint(1, PRODUCTS),
+                 "discount_ratio": rand.randint(0, 100),
+                 "counter": 0}
+                for number in range(start, min(start + SEED_CHUNK, rows))
+            ])
+
+
+def queries():
+    """ Returns the timed queries as (label, callable) pairs """
+    return [
+        ('find_by_name', lambda: Promotion.find_by_name('PROMO123').all()),
+        ('find_by_product_id', lambda: Promotion.find_by_product_id(4242).all()),
+        ('find_by_discount_ratio', lambda: Promotion.find_by_discount_ratio(42).limit(100).all()),
+        ('product_id + discount_ratio', lambda: Promotion.query.filter(
+            Promotion.product_id == 4242, Promotion.discount_ratio == 42).all()),
+    ]
+
+
+def measure(repeats):
+    """ Returns the median latency in milliseconds of each query """
+    results = {}
+    for label, query in queries():
+        timings = []
+        for _ in range(repeats):
+            start = time.time()
+            query()
+            timings.append((time.time() - start) * 1000)
+            db.session.remove()
+        timings.sort()
+        results[label] = timings[len(timings) // 2]
+    return results
+
+
+def main(rows, repeats):
+    """ Seeds the table and compares unindexed and indexed latency """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    db.drop_all()
+    db.create_all()
+    for index in Promotion.__table__.indexes:
+        index.drop(bind=db.engine)
+    start = time.time()
+    seed(rows)
+    print('Seeded {} promotions in {:.1f}s'.format(rows, time.time() - start))
+
+    before = measure(repeats)
+    start = time.time()
+    Promotion.create_indexes()
+    print('Created indexes in {:.1f}s'.format(time.time() - start))
+    after = measure(repeats)
+
+    print('{:<30}{:>14}{:>14}'.format('Query (median ms)', 'No index', 'Indexed'))
+    for label, _ in queries():
+        print('{:<30}{:>14.3f}{:>14.3f}'.format(label, before[label], after[label]))
+
+
+if __name__ == '__main__':
+    ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(ROWS, REPEATS)
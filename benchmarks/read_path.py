@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+Read Path Benchmark
+
+Seeds the promotion table (100,000 rows by default) and measures the cost
+per row of serializing a listing through the ORM, where every row becomes
+a session tracked Promotion, and through the Core fast read path that
+turns rows straight into dictionaries.
+
+Run it from the project root with:
+  python -m benchmarks.read_path [rows] [repeats]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - rows : Integer the number of promotions to seed and list (default 100000)
+    - repeats : Integer the number of timed runs of each path (default 5)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from app import db
+from app.models import Promotion, FIELDS
+from benchmarks import configure_database, SQLITE_URI
+from benchmarks.query_indexes import seed
+
+
+def orm_path(rows):
+    """ Lists rows Promotions as ORM objects and serializes them """
+    return [promotion.serialize() for promotion in Promotion.search({}, limit=rows)]
+
+
+def core_path(rows):
+    """ Lists rows Promotions with a Core SELECT straight into dictionaries """
+    return Promotion.serialize_rows(Promotion.search({}, limit=rows, fields=FIELDS), FIELDS)
+
+
+def export_path(rows):
+    """ Streams every Promotion through the Core keyset batches of the export """
+    return sum(1 for _ in Promotion.iter_rows(1000))
+
+
+def median_ms(path, rows, repeats):
+    """ Returns the median latency of a read path in milliseconds """
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        path(rows)
+        timings.append((time.time() - start) * 1000)
+        db.session.remove()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(rows, repeats):
+    """ Seeds the table and compares the ORM and Core read paths """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    db.drop_all()
+    db.create_all()
+    start = time.time()
+    seed(rows)
+    print('Seeded {} promotions in {:.1f}s'.format(rows, time.time() - start))
+
+    print('{:<26}{:>14}{:>14}'.format('Path', 'Median ms', 'us per row'))
+    for label, path in [('ORM (Promotion objects)', orm_path),
+                        ('Core rows', core_path),
+                        ('Core export batches', export_path)]:
+        elapsed = median_ms(path, rows, repeats)
+        print('{:<26}{:>14.1f}{:>14.2f}'.format(label, elapsed, elapsed * 1000 / rows))
+
+
+if __name__ == '__main__':
+    ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    main(ROWS, REPEATS)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""
+Redeem Buffer Benchmark
+
+Compares the throughput of POST /promotions/{id}/redeem with every
+redemption written straight to the database (direct) against the
+write-behind redemption buffer (buffered). Both runs hit a single hot
+promotion from parallel workers and check the final counter is exact.
+
+Run it from the project root with:
+  python -m benchmarks.redeem_buffer [redeems] [workers]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - redeems : Integer the number of redeems per run (default 2000)
+    - workers : Integer the number of parallel workers (default 20)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from app import app, db, server
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+
+
+def redeem(promotion_id):
+    """ Sends a single redeem through the test client """
+    client = app.test_client()
+    resp = client.post('/promotions/{}/redeem'.format(promotion_id))
+    db.session.remove()
+    return resp.status_code
+
+
+def run(mode, redeems, workers):
+    """ Redeems one promotion in the given mode and returns redeems/sec """
+    db.drop_all()
+    db.create_all()
+    promotion = Promotion(name='FLASHSALE', product_id=1, discount_ratio=50)
+    promotion.save()
+    promotion_id = promotion.promotion_id
+    db.session.remove()
+
+    app.config['REDEEM_BUFFER_ENABLED'] = (mode == 'buffered')
+    pool = ThreadPool(workers)
+    start = time.time()
+    codes = pool.map(redeem, [promotion_id] * redeems)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    server.redemption_buffer.stop()
+    app.config['REDEEM_BUFFER_ENABLED'] = False
+
+    counter = Promotion.find(promotion_id).counter
+    db.session.remove()
+    if counter != redeems or [code for code in codes if code != 200]:
+        raise AssertionError('{}: expected counter {} but got {}'.format(mode, redeems, counter))
+    return redeems / elapsed
+
+
+def main(redeems, workers):
+    """ Runs both modes and prints the comparison """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    direct = run('direct', redeems, workers)
+    buffered = run('buffered', redeems, workers)
+    print('Redeems per run: {} with {} workers'.format(redeems, workers))
+    print('Direct:          {:.1f} redeems/sec'.format(direct))
+    print('Buffered:        {:.1f} redeems/sec'.format(buffered))
+    print('Speedup:         {:.2f}x'.format(buffered / direct))
+
+
+if __name__ == '__main__':
+    REDEEMS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(REDEEMS, WORKERS)
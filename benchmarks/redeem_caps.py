@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""
+Redeem Caps Load Test
+
+Fires many more parallel POST /promotions/{id}/redeem calls at a promotion
+than its max_redemptions allows, half of them with the redemption buffer
+enabled, and checks that exactly max_redemptions succeed, the rest get
+409 Conflict and the final counter never goes past the cap.
+
+Run it from the project root with:
+  python -m benchmarks.redeem_caps [redeems] [workers] [max_redemptions]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - redeems : Integer the total number of redeems to send (default 2000)
+    - workers : Integer the number of parallel workers (default 50)
+    - max_redemptions : Integer the cap of the promotion (default 500)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from app import app, db, server
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+
+
+def redeem(promotion_id):
+    """ Sends a single redeem through the test client """
+    client = app.test_client()
+    resp = client.post('/promotions/{}/redeem'.format(promotion_id))
+    db.session.remove()
+    return resp.status_code
+
+
+def run(redeems, workers, max_redemptions, buffered):
+    """ Redeems a fresh capped promotion and returns (status codes, counter, seconds) """
+    db.drop_all()
+    db.create_all()
+    promotion = Promotion(name='FLASHSALE', product_id=1, discount_ratio=50,
+                          max_redemptions=max_redemptions)
+    promotion.save()
+    promotion_id = promotion.promotion_id
+    db.session.remove()
+
+    app.config['REDEEM_BUFFER_ENABLED'] = buffered
+    pool = ThreadPool(workers)
+    start = time.time()
+    codes = Counter(pool.map(redeem, [promotion_id] * redeems))
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    server.redemption_buffer.stop()
+    app.config['REDEEM_BUFFER_ENABLED'] = False
+    return codes, Promotion.find(promotion_id).counter, elapsed
+
+
+def main(redeems, workers, max_redemptions):
+    """ Runs the load test and returns the process exit code """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    failed = False
+    for buffered in (False, True):
+        codes, counter, elapsed = run(redeems, workers, max_redemptions, buffered)
+        print('Redemption buffer: {}'.format('enabled' if buffered else 'disabled'))
+        print('  Redeems sent:    {}'.format(redeems))
+        print('  Workers:         {}'.format(workers))
+        print('  Max redemptions: {}'.format(max_redemptions))
+        print('  200 OK:          {}'.format(codes[200]))
+        print('  409 Conflict:    {}'.format(codes[409]))
+        print('  Other statuses:  {}'.format(redeems - codes[200] - codes[409]))
+        print('  Final counter:   {}'.format(counter))
+        print('  Throughput:      {:.1f} redeems/sec'.format(redeems / elapsed))
+        expected = min(redeems, max_redemptions)
+        if counter != expected or codes[200] != expected or \
+           codes[409] != redeems - expected:
+            print('FAILED: expected a counter of {} with {} successes and {} conflicts'
+                  .format(expected, expected, redeems - expected))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    REDEEMS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    MAX_REDEMPTIONS = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    sys.exit(main(REDEEMS, WORKERS, MAX_REDEMPTIONS))
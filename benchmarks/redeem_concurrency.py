@@ -0,0 +1,72 @@
+#!/usr/bin/python
+"""
+Redeem Concurrency Benchmark
+
+Fires a large number of parallel POST /promotions/{id}/redeem calls at a
+single promotion and checks that the final counter is exact, then reports
+the throughput that was achieved.
+
+Run it from the project root with:
+  python -m benchmarks.redeem_concurrency [redeems] [workers]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: override the database (defaults to SQLite in db/)
+
+Arguments:
+----------
+    - redeems : Integer the total number of redeems to send (default 2000)
+    - workers : Integer the number of parallel workers (default 50)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from app import app, db
+from app.models import Promotion
+from benchmarks import configure_database, SQLITE_URI
+
+
+def redeem(promotion_id):
+    """ Sends a single redeem through the test client """
+    client = app.test_client()
+    resp = client.post('/promotions/{}/redeem'.format(promotion_id))
+    db.session.remove()
+    return resp.status_code
+
+
+def main(redeems, workers):
+    """ Runs the benchmark and returns the process exit code """
+    print('Database: {}'.format(configure_database(SQLITE_URI)))
+    db.drop_all()
+    db.create_all()
+    promotion = Promotion(name='FLASHSALE', product_id=1, discount_ratio=50)
+    promotion.save()
+    promotion_id = promotion.promotion_id
+    db.session.remove()
+
+    pool = ThreadPool(workers)
+    start = time.time()
+    codes = pool.map(redeem, [promotion_id] * redeems)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+
+    counter = Promotion.find(promotion_id).counter
+    failures = len([code for code in codes if code != 200])
+    print('Redeems sent:    {}'.format(redeems))
+    print('Workers:         {}'.format(workers))
+    print('Failed requests: {}'.format(failures))
+    print('Final counter:   {}'.format(counter))
+    print('Throughput:      {:.1f} redeems/sec'.format(redeems / elapsed))
+    if failures or counter != redeems:
+        print('FAILED: expected counter {} but got {}'.format(redeems, counter))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    REDEEMS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    sys.exit(main(REDEEMS, WORKERS))
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+Validation Benchmark
+
+Validates 100,000 promotion payloads (one in ten of them invalid by
+default) with the concatenation and exception checks deserialize used
+before, with Promotion.deserialize, which builds a Promotion for each
+payload, and with Promotion.validate, the compiled schema alone, and
+prints the payloads validated per second.
+
+Run it from the project root with:
+  python -m benchmarks.validation [payloads] [repeats]
+
+Arguments:
+----------
+    - payloads : Integer the number of payloads to validate (default 100000)
+    - repeats : Integer the number of timed runs of each validator (default 5)
+"""
+from __future__ import print_function
+
+import sys
+import time
+from app.models import Promotion, DataValidationError
+
+
+def payloads(count):
+    """ Returns count payloads, every tenth one with a bad field """
+    results = []
+    for number in range(count):
+        payload = {"name": u"PROMO{}".format(number), "product_id": number % 1000,
+                   "discount_ratio": number % 100}
+        if number % 30 == 9:
+            payload["discount_ratio"] = 101
+        elif number % 30 == 19:
+            payload["product_id"] = str(number)
+        elif number % 30 == 29:
+            del payload["name"]
+        results.append(payload)
+    return results
+
+
+def concatenation(data):
+    """ The checks of deserialize before the schema """
+    try:
+        name = "" + data['name']
+        product_id = 0 + data['product_id']
+        discount_ratio = 0 + data['discount_ratio']
+        if discount_ratio < 0 or discount_ratio > 100:
+            raise DataValidationError('Invalid promotion: discount_ratio out of range')
+        return {"name": name, "product_id": product_id, "discount_ratio": discount_ratio}
+    except KeyError as error:
+        raise DataValidationError('Invalid promotion: missing ' + error.args[0])
+    except TypeError:
+        raise DataValidationError('Invalid promotion: body of request contained bad or no data')
+
+
+def validators():
+    """ Returns the timed validators as (label, function) pairs """
+    return [('concatenation (before)', concatenation),
+            ('Promotion.deserialize', lambda data: Promotion().deserialize(data)),
+            ('Promotion.validate', Promotion.validate)]
+
+
+def median_seconds(validate, data, repeats):
+    """ Returns the median time to validate every payload """
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        for payload in data:
+            try:
+                validate(payload)
+            except DataValidationError:
+                pass
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(count, repeats):
+    """ Times every validator on the same payloads """
+    data = payloads(count)
+    print('{:<26}{:>12}{:>16}'.format('Validator', 'median ms', 'payloads/s'))
+    for label, validate in validators():
+        seconds = median_seconds(validate, data, repeats)
+        print('{:<26}{:>12.1f}{:>16,.0f}'.format(label, seconds * 1000, count / seconds))
+
+
+if __name__ == '__main__':
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    main(COUNT, REPEATS)
@@ -1,6 +1,6 @@
 import os
 import logging
-from app.vcap_services import get_database_uri
+from app.vcap_services import get_database_uri, get_pool_setting
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -12,9 +12,61 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = get_database_uri()
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-SQLALCHEMY_POOL_SIZE = 5
-SQLALCHEMY_POOL_TIMEOUT = 500
-SQLALCHEMY_POOL_RECYCLE = 300
+# Connection pool, set from the environment or the promotions-db-pool service
+SQLALCHEMY_POOL_SIZE = int(get_pool_setting('pool_size', '5'))
+SQLALCHEMY_MAX_OVERFLOW = int(get_pool_setting('max_overflow', '10'))
+SQLALCHEMY_POOL_TIMEOUT = float(get_pool_setting('pool_timeout', '500'))
+SQLALCHEMY_POOL_RECYCLE = int(get_pool_setting('pool_recycle', '300'))
+SQLALCHEMY_POOL_PRE_PING = (get_pool_setting('pool_pre_ping', 'False') == 'True')
+
+# Largest page GET /promotions returns, also used when no limit is given
+PROMOTIONS_MAX_PAGE_SIZE = int(os.getenv('PROMOTIONS_MAX_PAGE_SIZE', '1000'))
+
+# Rows fetched and sent per chunk by GET /promotions/export
+PROMOTIONS_EXPORT_BATCH_SIZE = int(os.getenv('PROMOTIONS_EXPORT_BATCH_SIZE', '1000'))
+
+# Promotions inserted per batch by POST /promotions/bulk
+PROMOTIONS_BULK_CHUNK_SIZE = int(os.getenv('PROMOTIONS_BULK_CHUNK_SIZE', '1000'))
+
+# Endpoints that serialize rows straight from Core SELECTs instead of
+# building Promotion objects (comma separated, empty to turn it off)
+PROMOTIONS_FAST_READ_ENDPOINTS = [endpoint for endpoint in os.getenv(
+    'PROMOTIONS_FAST_READ_ENDPOINTS', 'list_promotions,export_promotions').split(',') if endpoint]
+
+# Read-through cache of serialized promotions for GET /promotions/{id}
+PROMOTION_CACHE_SIZE = int(os.getenv('PROMOTION_CACHE_SIZE', '10000'))
+PROMOTION_CACHE_TTL = float(os.getenv('PROMOTION_CACHE_TTL', '60'))
+
+# Write-behind buffering of redemptions (opt-in)
+REDEEM_BUFFER_ENABLED = (os.getenv('REDEEM_BUFFER_ENABLED', 'False') == 'True')
+REDEEM_BUFFER_SHARDS = int(os.getenv('REDEEM_BUFFER_SHARDS', '16'))
+REDEEM_BUFFER_FLUSH_INTERVAL = float(os.getenv('REDEEM_BUFFER_FLUSH_INTERVAL', '1.0'))
+REDEEM_BUFFER_FLUSH_THRESHOLD = int(os.getenv('REDEEM_BUFFER_FLUSH_THRESHOLD', '1000'))
+
+# Append-only log of redemption events, written by batched INSERTs (opt-in)
+REDEMPTION_LOG_ENABLED = (os.getenv('REDEMPTION_LOG_ENABLED', 'False') == 'True')
+REDEMPTION_LOG_FLUSH_INTERVAL = float(os.getenv('REDEMPTION_LOG_FLUSH_INTERVAL', '1.0'))
+REDEMPTION_LOG_FLUSH_THRESHOLD = int(os.getenv('REDEMPTION_LOG_FLUSH_THRESHOLD', '1000'))
+REDEMPTION_LOG_BATCH_SIZE = int(os.getenv('REDEMPTION_LOG_BATCH_SIZE', '1000'))
+REDEMPTION_LOG_MAX_QUEUED = int(os.getenv('REDEMPTION_LOG_MAX_QUEUED', '100000'))
+
+# Responses kept for replaying the retries of requests with an Idempotency-Key
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+
+# JSON encoder of the API responses: auto (ujson if installed), ujson or json
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto')
+JSONIFY_PRETTYPRINT_REGULAR = (os.getenv('JSONIFY_PRETTYPRINT_REGULAR', 'False') == 'True')
+
+# Profiling of the SQL statements of a sample of the requests (opt-in):
+# a Server-Timing header, and a warning log of the requests slower than
+# SQL_PROFILE_SLOW_MS, running more than SQL_PROFILE_MAX_QUERIES statements
+# or the same statement SQL_PROFILE_REPEATED_QUERIES times (N+1)
+SQL_PROFILE_ENABLED = (os.getenv('SQL_PROFILE_ENABLED', 'False') == 'True')
+SQL_PROFILE_SAMPLE_RATE = float(os.getenv('SQL_PROFILE_SAMPLE_RATE', '1.0'))
+SQL_PROFILE_SLOW_MS = float(os.getenv('SQL_PROFILE_SLOW_MS', '500'))
+SQL_PROFILE_MAX_QUERIES = int(os.getenv('SQL_PROFILE_MAX_QUERIES', '20'))
+SQL_PROFILE_REPEATED_QUERIES = int(os.getenv('SQL_PROFILE_REPEATED_QUERIES', '5'))
 
 SECRET_KEY = 'secret-for-dev-only'
 LOGGING_LEVEL = logging.INFO
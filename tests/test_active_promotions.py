@@ -0,0 +1,128 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Active Promotion Index
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import random
+from mock import patch
+from app.active_promotions import IntervalTree, ActivePromotionIndex
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestIntervalTree(unittest.TestCase):
+    """ Test Cases for the Interval Tree """
+
+    def test_half_open(self):
+        """ A window contains its start but not its end """
+        tree = IntervalTree([(1, 3, 'a'), (3, 5, 'b'), (2, 2, 'empty')])
+        self.assertEqual(tree.stab(0), [])
+        self.assertEqual(tree.stab(1), ['a'])
+        self.assertEqual(tree.stab(2), ['a'])
+        self.assertEqual(tree.stab(3), ['b'])
+        self.assertEqual(tree.stab(5), [])
+        self.assertEqual(IntervalTree([]).stab(1), [])
+
+    def test_matches_a_scan(self):
+        """ The tree finds the same windows as checking every one """
+        generator = random.Random(42)
+        intervals = []
+        for value in range(500):
+            start = generator.randint(0, 1000)
+            intervals.append((start, start + generator.randint(0, 200), value))
+        tree = IntervalTree(intervals)
+        for point in range(-10, 1210, 7):
+            expected = sorted(value for start, end, value in intervals if start <= point < end)
+            self.assertEqual(sorted(tree.stab(point)), expected)
+
+
+class TestActivePromotionIndex(unittest.TestCase):
+    """ Test Cases for the Active Promotion Index """
+
+    def setUp(self):
+        self.windows = {1: [(10, 0, 5), (11, 3, 9)], 2: [(20, 0, 100)]}
+        self.loads = []
+        self.index = ActivePromotionIndex(self.load)
+
+    def load(self, product_id):
+        self.loads.append(product_id)
+        return self.windows.get(product_id, [])
+
+    def test_active(self):
+        """ Products are loaded once and answered from memory """
+        self.assertEqual(self.index.active(1, 4), [10, 11])
+        self.assertEqual(self.index.active(1, 7), [11])
+        self.assertEqual(self.index.active(3, 7), [])
+        self.assertEqual(self.loads, [1, 3])
+        self.assertEqual(len(self.index), 2)
+
+    def test_active_reloads_after_ttl(self):
+        """ A product is reloaded once it has been kept for the ttl """
+        index = ActivePromotionIndex(self.load, ttl=60)
+        with patch('app.active_promotions.time.time', return_value=1000.0) as clock:
+            self.assertEqual(index.active(1, 4), [10, 11])
+            clock.return_value = 1059.0
+            self.assertEqual(index.active(1, 4), [10, 11])
+            self.windows = {1: [(11, 3, 9)]}
+            clock.return_value = 1060.0
+            self.assertEqual(index.active(1, 4), [11])
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_promotion_saved(self):
+        """ Saving a promotion reloads its old and new products """
+        self.index.active(1, 0)
+        self.index.active(2, 0)
+        # promotion 10 moves from product 1 to product 2
+        self.windows = {1: [(11, 3, 9)], 2: [(20, 0, 100), (10, 50, 60)]}
+        self.index.promotion_saved(10, 2)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.active(1, 4), [11])
+        self.assertEqual(self.index.active(2, 55), [10, 20])
+
+    def test_promotion_removed(self):
+        """ Removing a promotion reloads its product """
+        self.index.active(1, 0)
+        self.index.active(2, 0)
+        self.windows = {1: [(11, 3, 9)]}
+        self.index.promotion_removed(10)
+        self.index.promotion_removed(99)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.active(1, 4), [11])
+
+    def test_stale_load(self):
+        """ A load that raced a write isn't kept """
+        def racing_load(product_id):
+            self.index.promotion_saved(12, product_id)
+            return self.windows[product_id]
+        self.index = ActivePromotionIndex(racing_load)
+        self.assertEqual(self.index.active(1, 4), [10, 11])
+        self.assertEqual(len(self.index), 0)
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Best Promotion Index
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from mock import MagicMock, patch
+from app.best_promotions import BestPromotionIndex
+
+EVER = datetime(1000, 1, 1)
+NOW = datetime(2018, 6, 1)
+LATER = datetime(2018, 7, 1)
+NEVER = datetime(9999, 12, 31)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestBestPromotionIndex(unittest.TestCase):
+    """ Test Cases for the Best Promotion Index """
+
+    def setUp(self):
+        self.loader = MagicMock(return_value=((50, 2), None))
+        self.index = BestPromotionIndex(self.loader)
+
+    def test_get_loads_once(self):
+        """ A product is loaded on first use and then served from memory """
+        self.assertEqual(self.index.get(1, NOW), (50, 2))
+        self.assertEqual(self.index.get(1, NOW), (50, 2))
+        self.loader.assert_called_once_with(1, NOW)
+
+    def test_get_remembers_products_without_promotions(self):
+        """ A product without promotions is not loaded again """
+        self.loader.return_value = (None, None)
+        self.assertIsNone(self.index.get(1, NOW))
+        self.assertIsNone(self.index.get(1, NOW))
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_get_reloads_when_best_may_change(self):
+        """ A product is reloaded once the time its best may change has come """
+        self.loader.return_value = ((50, 2), LATER)
+        self.index.get(1, NOW)
+        self.assertEqual(self.index.get(1, LATER - timedelta(seconds=1)), (50, 2))
+        self.loader.return_value = ((40, 3), None)
+        self.assertEqual(self.index.get(1, LATER), (40, 3))
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_get_reloads_after_ttl(self):
+        """ A product is reloaded once it has been kept for the ttl """
+        index = BestPromotionIndex(self.loader, ttl=60)
+        with patch('app.best_promotions.time.time', return_value=1000.0) as clock:
+            index.get(1, NOW)
+            clock.return_value = 1059.0
+            self.assertEqual(index.get(1, NOW), (50, 2))
+            self.assertEqual(self.loader.call_count, 1)
+            self.loader.return_value = ((40, 3), None)
+            clock.return_value = 1060.0
+            self.assertEqual(index.get(1, NOW), (40, 3))
+            self.assertEqual(self.loader.call_count, 2)
+            index.rebuild([(1, 10, 1, EVER, NEVER)], NOW)
+            clock.return_value = 1120.0
+            self.assertEqual(index.get(1, NOW), (40, 3))
+            self.assertEqual(self.loader.call_count, 3)
+
+    def test_reload(self):
+        """ A product can be reloaded at once """
+        self.index.get(1, NOW)
+        self.loader.return_value = ((40, 3), None)
+        self.assertEqual(self.index.reload(1, NOW), (40, 3))
+        self.assertEqual(self.index.get(1, NOW), (40, 3))
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_saved_promotion_beats_best(self):
+        """ A better promotion replaces the best one """
+        self.index.get(1, NOW)
+        self.index.promotion_saved(3, 1, 60)
+        self.assertEqual(self.index.get(1, NOW), (60, 3))
+        self.index.promotion_saved(1, 1, 60)
+        self.assertEqual(self.index.get(1, NOW), (60, 1))
+        self.index.promotion_saved(4, 1, 10)
+        self.assertEqual(self.index.get(1, NOW), (60, 1))
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_saved_promotion_window(self):
+        """ A saved promotion only competes while it is active """
+        self.index.get(1, NOW)
+        # ended, then not started yet
+        self.index.promotion_saved(3, 1, 90, NOW - timedelta(days=2), NOW - timedelta(days=1),
+                                   NOW)
+        self.assertEqual(self.index.get(1, NOW), (50, 2))
+        self.index.promotion_saved(4, 1, 90, LATER, None, NOW)
+        self.assertEqual(self.index.get(1, NOW), (50, 2))
+        self.assertEqual(self.loader.call_count, 1)
+        self.loader.return_value = ((90, 4), None)
+        self.assertEqual(self.index.get(1, LATER), (90, 4))
+        self.assertEqual(self.loader.call_count, 2)
+        # active until LATER + 1 day
+        self.index.promotion_saved(5, 1, 95, LATER, LATER + timedelta(days=1), LATER)
+        self.assertEqual(self.index.get(1, LATER), (95, 5))
+        self.loader.return_value = ((90, 4), None)
+        self.assertEqual(self.index.get(1, LATER + timedelta(days=1)), (90, 4))
+
+    def test_changed_best_is_reloaded(self):
+        """ Changing or removing the best promotion reloads the product """
+        self.index.get(1, NOW)
+        self.loader.return_value = ((40, 5), None)
+        self.index.promotion_saved(2, 1, 10)
+        self.assertEqual(self.index.get(1, NOW), (40, 5))
+        self.loader.return_value = (None, None)
+        self.index.promotion_removed(5)
+        self.assertIsNone(self.index.get(1, NOW))
+        self.assertEqual(self.loader.call_count, 3)
+
+    def test_rebuild(self):
+        """ Rebuild precomputes the best active promotion of every product """
+        self.index.rebuild([(1, 10, 1, EVER, NEVER), (1, 30, 2, EVER, NEVER),
+                            (2, 30, 4, EVER, NEVER), (2, 30, 3, EVER, LATER),
+                            (2, 90, 6, EVER, NOW), (2, 90, 7, LATER, NEVER),
+                            (3, None, 5, EVER, NEVER)], NOW)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.get(1, NOW), (30, 2))
+        self.assertEqual(self.index.get(2, NOW), (30, 3))
+        self.assertFalse(self.loader.called)
+        # the best of product 2 ends and another one starts at LATER
+        self.assertEqual(self.index.get(2, LATER), (50, 2))
+        self.loader.assert_called_once_with(2, LATER)
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the LRU Cache
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from mock import patch
+from app.cache import LRUCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRU Cache """
+
+    def test_get_and_set(self):
+        """ Store and fetch a value """
+        cache = LRUCache(maxsize=2)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, 'one')
+        self.assertEqual(cache.get(1), 'one')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_evicts_least_recently_used(self):
+        """ The least recently used entry is evicted first """
+        cache = LRUCache(maxsize=2)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'one')
+        self.assertEqual(cache.get(3), 'three')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @patch('app.cache.time.time')
+    def test_entries_expire(self, time_mock):
+        """ Entries are dropped after their time to live """
+        time_mock.return_value = 100.0
+        cache = LRUCache(maxsize=2, ttl=10)
+        cache.set(1, 'one')
+        time_mock.return_value = 109.0
+        self.assertEqual(cache.get(1), 'one')
+        time_mock.return_value = 110.0
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalidate_and_clear(self):
+        """ Invalidate removes one entry and clear removes them all """
+        cache = LRUCache(maxsize=4)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), 'two')
+        cache.clear()
+        self.assertIsNone(cache.get(2))
+
+    def test_stale_set_is_ignored(self):
+        """ A value loaded before an invalidation is not cached """
+        cache = LRUCache(maxsize=4)
+        generation = cache.generation(1)
+        cache.invalidate(1)
+        cache.set(1, 'stale', generation)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, 'fresh', cache.generation(1))
+        self.assertEqual(cache.get(1), 'fresh')
+
+    def test_disabled(self):
+        """ A maxsize of 0 caches nothing """
+        cache = LRUCache(maxsize=0)
+        cache.set(1, 'one')
+        self.assertIsNone(cache.get(1))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
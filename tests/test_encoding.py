@@ -0,0 +1,104 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the JSON Encoding
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import json
+from mock import patch
+from app import app
+from app import encoding
+from app.encoding import EncodedDict, jsonify, dumps, etag, etag_base
+
+PROMOTION = {"promotion_id": 1, "name": "20%OFF/1", "product_id": 9527,
+             "discount_ratio": None, "counter": 0}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for the JSON Encoding """
+
+    def test_encoders_agree(self):
+        """ Every available encoder produces the same compact JSON """
+        for name in encoding.ENCODERS:
+            with patch.dict(app.config, {'JSON_ENCODER': name}):
+                body = dumps([PROMOTION])
+            self.assertEqual(json.loads(body), [PROMOTION])
+            self.assertNotIn(': ', body)
+            self.assertIn('20%OFF/1', body)
+
+    def test_encoder_selection(self):
+        """ auto prefers ujson and unknown encoders fall back to json """
+        with patch.dict(app.config, {'JSON_ENCODER': 'auto'}):
+            expected = 'ujson' if 'ujson' in encoding.ENCODERS else 'json'
+            self.assertEqual(encoding.encoder_name(), expected)
+        with patch.dict(app.config, {'JSON_ENCODER': 'bogus'}):
+            self.assertEqual(encoding.encoder_name(), 'json')
+
+    def test_pretty_print(self):
+        """ Responses are indented when pretty printing is on """
+        with patch.dict(app.config, {'JSONIFY_PRETTYPRINT_REGULAR': True}):
+            body = dumps(PROMOTION)
+        self.assertIn('\n  "counter": 0', body)
+
+    def test_encoded_dict(self):
+        """ An EncodedDict is only encoded once """
+        data = EncodedDict(PROMOTION)
+        with patch('app.encoding.dumps', return_value='{}') as dumps_mock:
+            self.assertEqual(data.encoded(), '{}')
+            self.assertEqual(data.encoded(), '{}')
+        self.assertEqual(dumps_mock.call_count, 1)
+
+    def test_etag(self):
+        """ Equal data has the same ETag however it was built """
+        reordered = dict(reversed(list(PROMOTION.items())))
+        self.assertEqual(etag(PROMOTION), etag(reordered))
+        self.assertEqual(etag(EncodedDict(PROMOTION)), etag(PROMOTION))
+        self.assertNotEqual(etag(PROMOTION), etag(dict(PROMOTION, counter=1)))
+
+    def test_etag_volatile(self):
+        """ A volatile value changes the ETag but not its base """
+        tag = etag(PROMOTION, 'counter')
+        redeemed = etag(dict(PROMOTION, counter=1), 'counter')
+        self.assertNotEqual(tag, redeemed)
+        self.assertEqual(etag_base(tag), etag_base(redeemed))
+        self.assertNotEqual(etag_base(tag), etag_base(etag(dict(PROMOTION, name='X'), 'counter')))
+        self.assertEqual(etag(EncodedDict(PROMOTION), 'counter'), tag)
+        self.assertEqual(etag({'name': 'X'}, 'counter'), etag({'name': 'X'}))
+
+    def test_jsonify(self):
+        """ jsonify takes one value, several values or keywords """
+        with app.test_request_context():
+            resp = jsonify(PROMOTION)
+            self.assertEqual(resp.mimetype, 'application/json')
+            self.assertEqual(json.loads(resp.data), PROMOTION)
+            self.assertEqual(json.loads(jsonify(1, 2).data), [1, 2])
+            self.assertEqual(json.loads(jsonify(status=400).data), {'status': 400})
+            self.assertRaises(TypeError, jsonify, 1, status=400)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
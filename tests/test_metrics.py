@@ -0,0 +1,109 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Request Metrics
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import threading
+from flask import g
+from sqlalchemy import create_engine
+from app import app
+from app.metrics import Histogram, RequestMetrics, format_labels, gauges
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestRequestMetrics(unittest.TestCase):
+    """ Test Cases for the Request Metrics """
+
+    def test_histogram(self):
+        """ Histogram buckets are cumulative and include their bound """
+        histogram = Histogram((1, 5))
+        for value in (0, 1, 3, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.samples('x', (('a', 'b'),)),
+                         ['x_bucket{a="b",le="1"} 2',
+                          'x_bucket{a="b",le="5"} 3',
+                          'x_bucket{a="b",le="+Inf"} 4',
+                          'x_sum{a="b"} 11.0',
+                          'x_count{a="b"} 4'])
+
+    def test_render(self):
+        """ Requests are counted by endpoint, method and status """
+        metrics = RequestMetrics()
+        metrics.observe('get_promotions', 'GET', 200, 0.002, 1, 0.001)
+        metrics.observe('get_promotions', 'GET', 404, 0.002, 1, 0.001)
+        metrics.observe('get_promotions', 'GET', 200, 0.02, 0)
+        lines = metrics.render()
+        self.assertIn('promotions_http_requests_total{endpoint="get_promotions",method="GET",'
+                      'status="200"} 2', lines)
+        self.assertIn('promotions_http_request_duration_seconds_bucket{endpoint="get_promotions",'
+                      'method="GET",le="0.005"} 2', lines)
+        self.assertIn('promotions_db_queries_per_request_bucket{endpoint="get_promotions",'
+                      'le="0"} 1', lines)
+        self.assertIn('promotions_db_query_seconds_total{endpoint="get_promotions"} 0.002', lines)
+        metrics.reset()
+        self.assertFalse([line for line in metrics.render() if not line.startswith('#')])
+
+    def test_threaded_observations(self):
+        """ No observation is lost under concurrent requests """
+        metrics = RequestMetrics()
+
+        def serve():
+            for _ in range(1000):
+                metrics.observe('list_promotions', 'GET', 200, 0.001)
+
+        threads = [threading.Thread(target=serve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn('promotions_http_requests_total{endpoint="list_promotions",method="GET",'
+                      'status="200"} 8000', metrics.render())
+
+    def test_format_labels(self):
+        """ Label values are escaped """
+        self.assertEqual(format_labels((('name', 'a"b\\c'),)), '{name="a\\"b\\\\c"}')
+
+    def test_gauges(self):
+        """ Only numeric statistics become gauges """
+        lines = gauges('cache', {'hits': 3, 'ttl': 0.5, 'maxsize': None, 'on': True}, 'Cache')
+        self.assertIn('cache_hits 3', lines)
+        self.assertIn('cache_ttl 0.5', lines)
+        self.assertEqual(len(lines), 6)
+
+    def test_query_tracking(self):
+        """ SQL queries are counted in the request that ran them """
+        engine = create_engine('sqlite://')
+        engine.execute('SELECT 1')
+        with app.test_request_context():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            self.assertEqual(g.db_queries, 2)
+            self.assertGreaterEqual(g.db_query_seconds, 0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Connection Pool
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import json
+import sqlite3
+from mock import patch
+from sqlalchemy import create_engine, exc
+from app.pool import InstrumentedQueuePool, pool_metrics
+from app.vcap_services import get_pool_setting
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestInstrumentedQueuePool(unittest.TestCase):
+    """ Test Cases for the Connection Pool """
+
+    def setUp(self):
+        pool_metrics.reset()
+
+    @staticmethod
+    def make_pool(**kwargs):
+        return InstrumentedQueuePool(lambda: sqlite3.connect(':memory:'), **kwargs)
+
+    def test_checkouts(self):
+        """ Checkouts and the connections in use are counted """
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+        first = pool.connect()
+        second = pool.connect()
+        stats = pool_metrics.stats(pool)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual((stats['in_use'], stats['idle']), (2, 0))
+        first.close()
+        second.close()
+        stats = pool_metrics.stats(pool)
+        self.assertEqual((stats['in_use'], stats['idle']), (0, 2))
+        self.assertEqual(stats['size'], 2)
+
+    def test_timeouts(self):
+        """ Checkouts of a saturated pool time out and are counted """
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        stats = pool_metrics.stats(pool)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0)
+        connection.close()
+
+    def test_pre_ping(self):
+        """ Dropped connections are replaced on checkout """
+        pool = self.make_pool(pool_size=1, max_overflow=0, pre_ping=True)
+        connection = pool.connect()
+        stale = connection.connection
+        connection.close()
+        stale.close()  # as if the database had dropped it
+        connection = pool.connect()
+        self.assertIsNot(connection.connection, stale)
+        self.assertEqual(pool_metrics.stats()['disconnects'], 1)
+        connection.close()
+        # recreating the pool keeps the ping
+        pool = pool.recreate()
+        connection = pool.connect()
+        stale = connection.connection
+        connection.close()
+        stale.close()
+        pool.connect().close()
+        self.assertEqual(pool_metrics.stats()['disconnects'], 2)
+
+    def test_engine_checkouts(self):
+        """ Checkouts made by an Engine are counted """
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0)
+        with engine.connect() as conn:
+            conn.execute('SELECT 1')
+        with engine.begin() as conn:
+            conn.execute('SELECT 1')
+        engine.execute('SELECT 1')
+        self.assertEqual(pool_metrics.stats(engine.pool)['checkouts'], 3)
+
+    def test_stats_without_queue_pool(self):
+        """ Only the counters are reported for other pools """
+        self.assertNotIn('in_use', pool_metrics.stats(None))
+
+
+class TestPoolSettings(unittest.TestCase):
+    """ Test Cases for the Connection Pool settings """
+
+    @patch.dict(os.environ, {'SQLALCHEMY_POOL_SIZE': '7'})
+    def test_from_environment(self):
+        """ Pool settings come from the environment first """
+        self.assertEqual(get_pool_setting('pool_size', '5'), '7')
+
+    def test_from_vcap_services(self):
+        """ Pool settings come from the promotions-db-pool service """
+        services = {'user-provided': [{'name': 'promotions-db-pool',
+                                       'credentials': {'max_overflow': 3}}]}
+        with patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(services)}):
+            self.assertEqual(get_pool_setting('max_overflow', '10'), '3')
+            self.assertEqual(get_pool_setting('pool_recycle', '300'), '300')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
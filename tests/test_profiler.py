@@ -0,0 +1,83 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the SQL Profiler
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from mock import patch
+from app.profiler import SqlProfile, sampled
+
+SELECT = 'SELECT promotions.name FROM promotions WHERE promotions.promotion_id = ?'
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestSqlProfile(unittest.TestCase):
+    """ Test Cases for the SQL Profiler """
+
+    def setUp(self):
+        self.profile = SqlProfile()
+        for _ in range(3):
+            self.profile.add(SELECT, 0.001)
+        self.profile.add('UPDATE promotions\nSET counter=?', 0.002)
+
+    def test_totals(self):
+        """ Statements are counted and timed """
+        self.assertEqual(self.profile.count, 4)
+        self.assertAlmostEqual(self.profile.seconds, 0.005)
+
+    def test_server_timing(self):
+        """ The Server-Timing header has the SQL and total times in ms """
+        self.assertEqual(self.profile.server_timing(0.0123),
+                         'db;dur=5.00;desc="4 queries", total;dur=12.30')
+
+    def test_repeated(self):
+        """ Statements run many times are found """
+        self.assertEqual(self.profile.repeated(3), [(SELECT, 3)])
+        self.assertEqual(self.profile.repeated(4), [])
+
+    def test_problems(self):
+        """ Slow requests, many queries and repeated queries are reported """
+        self.assertEqual(self.profile.problems(0.01, 500, 20, 5), [])
+        self.assertEqual(self.profile.problems(0.6, 500, 3, 3),
+                         ['took 600.0ms', 'ran 4 queries', 'ran 3 times: ' + SELECT])
+
+    def test_report(self):
+        """ The report has one line per statement """
+        report = self.profile.report()
+        self.assertEqual(len(report), 4)
+        self.assertEqual(report[-1], '  2.00ms UPDATE promotions SET counter=?')
+
+    def test_sampled(self):
+        """ Requests are sampled at the given rate """
+        self.assertTrue(sampled(1.0))
+        self.assertFalse(sampled(0.0))
+        with patch('random.random', return_value=0.2):
+            self.assertTrue(sampled(0.25))
+            self.assertFalse(sampled(0.1))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
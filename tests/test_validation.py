@@ -0,0 +1,112 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the payload Validation
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime
+from app.validation import Field, Schema, describe, parse_datetime, format_datetime
+
+SCHEMA = Schema([
+    Field('name', 'string', max_length=5),
+    Field('code', 'string', required=False),
+    Field('count', 'integer', minimum=0),
+    Field('ratio', 'integer', minimum=0, maximum=100),
+    Field('delta', 'integer', maximum=10, required=False),
+    Field('when', 'datetime', required=False, nullable=True),
+    Field('cap', 'integer', required=False, nullable=True, minimum=0),
+])
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestSchema(unittest.TestCase):
+    """ Test Cases for the payload Validation """
+
+    def test_valid(self):
+        """ Valid fields are returned and unknown fields ignored """
+        data = {'name': u'ab', 'count': 3L, 'ratio': 100, 'other': object()}
+        self.assertEqual(SCHEMA.validate(data), ({'name': u'ab', 'count': 3, 'ratio': 100}, {}))
+
+    def test_all_errors(self):
+        """ Every invalid field is reported at once """
+        data = {'name': 'toolong', 'code': 1, 'count': -1, 'ratio': True, 'delta': 11}
+        values, errors = SCHEMA.validate(data)
+        self.assertEqual(values, {})
+        self.assertEqual(errors, {'name': 'must be at most 5 characters',
+                                  'code': 'must be a string',
+                                  'count': 'must be at least 0',
+                                  'ratio': 'must be an integer',
+                                  'delta': 'must be at most 10'})
+
+    def test_types(self):
+        """ Floats, booleans and strings aren't integers """
+        for value in (1.0, False, '1', None):
+            self.assertEqual(SCHEMA.validate({'ratio': value}, partial=True)[1],
+                             {'ratio': 'must be an integer'})
+        self.assertEqual(SCHEMA.validate({'ratio': 101}, partial=True)[1],
+                         {'ratio': 'must be between 0 and 100'})
+
+    def test_nullable(self):
+        """ Only nullable fields accept None """
+        self.assertEqual(SCHEMA.validate({'cap': None, 'count': None}, partial=True),
+                         ({'cap': None}, {'count': 'must be an integer'}))
+        self.assertEqual(SCHEMA.validate({'cap': -1}, partial=True)[1],
+                         {'cap': 'must be at least 0'})
+
+    def test_missing(self):
+        """ Required fields are only missing when not partial """
+        self.assertEqual(SCHEMA.validate({})[1],
+                         {'name': 'is required', 'count': 'is required', 'ratio': 'is required'})
+        self.assertEqual(SCHEMA.validate({}, partial=True), ({}, {}))
+
+    def test_datetimes(self):
+        """ Datetimes are parsed from ISO 8601 strings """
+        self.assertEqual(SCHEMA.validate({'when': u'2018-07-04T09:30:00.5Z'}, partial=True),
+                         ({'when': datetime(2018, 7, 4, 9, 30)}, {}))
+        self.assertEqual(SCHEMA.validate({'when': None}, partial=True), ({'when': None}, {}))
+        for value in ('2018-02-30', '2018-07-04 09:30:00', '0999-01-01', '2018-07-04\n', 1):
+            self.assertEqual(SCHEMA.validate({'when': value}, partial=True)[1],
+                             {'when': 'must be an ISO 8601 datetime'})
+
+    def test_parse_and_format_datetime(self):
+        """ Datetimes round trip through their ISO 8601 strings """
+        self.assertEqual(parse_datetime('2018-07-04'), datetime(2018, 7, 4))
+        self.assertIsNone(parse_datetime('2018-07-04T25:00:00'))
+        self.assertEqual(format_datetime(datetime(2018, 7, 4, 9, 30, 0, 500)),
+                         '2018-07-04T09:30:00')
+
+    def test_describe(self):
+        """ Errors are described in field order """
+        self.assertEqual(describe({'b': 'is required', 'a': 'must be a string'}),
+                         'a must be a string; b is required')
+
+    def test_unknown_kind(self):
+        """ Only strings and integers can be checked """
+        self.assertRaises(ValueError, Field, 'x', 'date')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()